@@ -0,0 +1,283 @@
+"""Local XML-RPC stand-in for a Koji hub used by graffiti benchmarks
+
+It implements the subset of the hub API used by graffiti on synthetic
+tags, adds a configurable latency to every HTTP request and counts
+requests, calls and bytes transferred.
+"""
+from __future__ import print_function
+import argparse
+import threading
+import time
+
+try:
+    from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SimpleXMLRPCServer import (SimpleXMLRPCRequestHandler,
+                                    SimpleXMLRPCServer)
+    from SocketServer import ThreadingMixIn
+
+from koji import decode_args
+
+
+RELEASE_TAGS = ['bench-candidate', 'bench-testing', 'bench-release']
+
+
+def synthetic_data(packages, builds_per_package):
+    """Generate tags with packages * builds_per_package builds
+    Every build is in candidate, older half of them in testing and
+    older quarter in release
+    """
+    tags = dict((name, i + 1) for i, name in enumerate(RELEASE_TAGS))
+    builds = {}
+    tagged = dict((tag, []) for tag in RELEASE_TAGS)
+    build_id = 0
+    for pkg in range(packages):
+        name = 'python-bench{}'.format(pkg)
+        for version in range(builds_per_package):
+            build_id += 1
+            nvr = '{}-{}.0.0-1.el9s'.format(name, version)
+            builds[nvr] = build_id
+            tagged['bench-candidate'].append(nvr)
+            if version < builds_per_package / 2:
+                tagged['bench-testing'].append(nvr)
+            if version < builds_per_package / 4:
+                tagged['bench-release'].append(nvr)
+    return tags, builds, tagged
+
+
+class FakeHub(object):
+    """Koji hub API on in-memory data
+    """
+    def __init__(self, packages=1000, builds_per_package=4):
+        self.lock = threading.RLock()
+        self.packages = packages
+        self.builds_per_package = builds_per_package
+        self.reset_data()
+
+    def reset_data(self):
+        with self.lock:
+            self.tags, self.builds, tagged = synthetic_data(
+                self.packages, self.builds_per_package)
+            self.tagged = dict((tag, set(nvrs))
+                               for tag, nvrs in tagged.items())
+            self.nvrs = dict((b, nvr) for nvr, b in self.builds.items())
+            self.package_lists = dict((tag, set()) for tag in self.tags)
+            self.history = []
+            self.event = 1
+
+    def _tag(self, tag):
+        if tag in self.tags:
+            return tag
+        for name, tag_id in self.tags.items():
+            if tag_id == tag:
+                return name
+        raise Exception('No such tag: {}'.format(tag))
+
+    def _build(self, nvr):
+        name, version, release = nvr.rsplit('-', 2)
+        return {'build_id': self.builds[nvr], 'id': self.builds[nvr],
+                'nvr': nvr, 'name': name, 'package_name': name,
+                'version': version, 'release': release, 'state': 1}
+
+    def getLastEvent(self):
+        return {'id': self.event, 'ts': time.time()}
+
+    def listTags(self, build=None):
+        if build is None:
+            return [{'name': n, 'id': i} for n, i in self.tags.items()]
+        if build not in self.builds:
+            raise Exception('No such build: {}'.format(build))
+        return [{'name': tag, 'id': self.tags[tag]}
+                for tag, nvrs in self.tagged.items() if build in nvrs]
+
+    def getTag(self, tag):
+        try:
+            name = self._tag(tag)
+        except Exception:
+            return None
+        return {'name': name, 'id': self.tags[name]}
+
+    def getBuild(self, build):
+        if build not in self.builds:
+            return None
+        return self._build(build)
+
+    def listTagged(self, tag, latest=False, package=None, event=None):
+        builds = [self._build(nvr) for nvr in self.tagged[self._tag(tag)]
+                  if package is None or nvr.rsplit('-', 2)[0] == package]
+        builds.sort(key=lambda b: b['build_id'], reverse=True)
+        if latest:
+            seen = set()
+            builds = [b for b in builds if b['name'] not in seen and
+                      not seen.add(b['name'])]
+        return builds
+
+    def queryHistory(self, tables=None, tag=None, afterEvent=None, **kw):
+        # synthetic tags initial content has no history
+        after = afterEvent or 0
+        with self.lock:
+            name = self._tag(tag) if tag is not None else None
+            return {'tag_listing': [
+                dict(entry) for entry in self.history
+                if (name is None or entry['tag.name'] == name) and
+                (entry['create_event'] > after or
+                 (entry['revoke_event'] or 0) > after)]}
+
+    def tagBuild(self, tag, build, force=False):
+        with self.lock:
+            name = self._tag(tag)
+            if build in self.tagged[name]:
+                return
+            self.event += 1
+            self.tagged[name].add(build)
+            entry = self._build(build)
+            entry.update({'tag.name': name, 'tag_id': self.tags[name],
+                          'create_event': self.event, 'revoke_event': None,
+                          'active': True})
+            self.history.append(entry)
+
+    def untagBuild(self, tag, build, strict=True, force=False):
+        with self.lock:
+            name = self._tag(tag)
+            if build not in self.tagged[name]:
+                return
+            self.event += 1
+            self.tagged[name].discard(build)
+            active = [entry for entry in self.history
+                      if entry['tag.name'] == name and
+                      entry['nvr'] == build and entry['active']]
+            if not active:
+                # initial content, tagged before the first event
+                entry = self._build(build)
+                entry.update({'tag.name': name, 'tag_id': self.tags[name],
+                              'create_event': 0})
+                self.history.append(entry)
+                active = [entry]
+            for entry in active:
+                entry.update({'revoke_event': self.event, 'active': None})
+
+    def packageListAdd(self, tag, pkg, owner=None, **kw):
+        with self.lock:
+            self.event += 1
+            self.package_lists[self._tag(tag)].add(pkg)
+
+    def packageListRemove(self, tag, pkg, force=False, **kw):
+        with self.lock:
+            self.event += 1
+            self.package_lists[self._tag(tag)].discard(pkg)
+
+    def listPackages(self, tagID=None, **kw):
+        return [{'package_name': pkg}
+                for pkg in sorted(self.package_lists[self._tag(tagID)])]
+
+    def subsession(self):
+        return {'session-id': 1, 'session-key': 'bench'}
+
+    def logout(self, session_id=None):
+        return None
+
+
+class StatsServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """XML-RPC server counting traffic and adding latency
+    """
+    daemon_threads = True
+
+    def __init__(self, address, hub, latency=0.0):
+        SimpleXMLRPCServer.__init__(self, address,
+                                    requestHandler=RequestHandler,
+                                    allow_none=True, logRequests=False)
+        self.hub = hub
+        self.latency = latency
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'calls': 0, 'bytes_in': 0,
+                      'bytes_out': 0, 'multicall_sizes': []}
+
+    def _call(self, method, params):
+        args, kwargs = decode_args(*params)
+        return getattr(self.hub, method)(*args, **kwargs)
+
+    def _dispatch(self, method, params):
+        if method.startswith('bench.'):
+            return getattr(self, 'bench_' + method[len('bench.'):])(*params)
+        if method == 'multiCall':
+            calls = params[0]
+            with self.stats_lock:
+                self.stats['calls'] += len(calls)
+                self.stats['multicall_sizes'].append(len(calls))
+            results = []
+            for c in calls:
+                try:
+                    results.append([self._call(c['methodName'],
+                                               c['params'])])
+                except Exception as exc:
+                    results.append({'faultCode': 1000,
+                                    'faultString': str(exc)})
+            return results
+        with self.stats_lock:
+            self.stats['calls'] += 1
+        return self._call(method, params)
+
+    def _marshaled_dispatch(self, data, dispatch_method=None, path=None):
+        response = SimpleXMLRPCServer._marshaled_dispatch(
+            self, data, dispatch_method, path)
+        if b'bench.' not in data[:200]:
+            time.sleep(self.latency)
+            with self.stats_lock:
+                self.stats['requests'] += 1
+                self.stats['bytes_in'] += len(data)
+                self.stats['bytes_out'] += len(response)
+        return response
+
+    def bench_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def bench_reset(self):
+        self.hub.reset_data()
+        with self.stats_lock:
+            self.reset_stats()
+        return True
+
+    def bench_configure(self, packages, builds_per_package, latency):
+        self.hub.packages = packages
+        self.hub.builds_per_package = builds_per_package
+        self.latency = latency
+        return self.bench_reset()
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    # koji posts to the hub url path
+    rpc_paths = ()
+
+
+def serve(host='127.0.0.1', port=0, packages=1000, builds_per_package=4,
+          latency=0.0, ready=None):
+    """Run a fake hub until interrupted, ready(port) is called once
+    listening
+    """
+    server = StatsServer((host, port), FakeHub(packages, builds_per_package),
+                         latency)
+    if ready:
+        ready(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser('graffiti benchmark koji hub')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--packages', type=int, default=1000)
+    parser.add_argument('--builds-per-package', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    args = parser.parse_args()
+    serve(port=args.port, packages=args.packages,
+          builds_per_package=args.builds_per_package, latency=args.latency,
+          ready=lambda port: print('fake hub listening on {}'.format(port)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""graffiti benchmarks against a local fake Koji hub
+
+Runs graffiti operations on synthetic tags of several sizes and reports
+wall time, HTTP requests, koji calls, bytes transferred and peak memory.
+
+    python benchmarks/run.py --sizes 1000 5000 --latency 0.02
+    python benchmarks/run.py --json new.json --baseline old.json
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    from xmlrpc.client import ServerProxy
+except ImportError:
+    from xmlrpclib import ServerProxy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import fake_hub  # noqa: E402
+from graffiti import cli  # noqa: E402
+from graffiti.config import parse_config  # noqa: E402
+from graffiti.kojiclient import KojiClient  # noqa: E402
+
+BUILDS_PER_PACKAGE = 4
+
+TAGS_MAP = {'candidate': [0], 'testing': [0, 1], 'release': [0, 1, 2]}
+
+RDOINFO_RELEASE = """- name: release{0}
+  branch: release{0}-rdo
+  repos:
+  - name: el9s
+    buildsys: cbs/cloud9s-openstack-release{0}-el9s
+    buildsys-tags:
+    - cloud9s-openstack-release{0}-candidate
+    - cloud9s-openstack-release{0}-testing
+    - cloud9s-openstack-release{0}-release
+"""
+
+
+def koji_client(url):
+    client = KojiClient(url)
+    # the fake hub does not authenticate
+    client.authenticated = True
+    return client
+
+
+def bench_list_candidates(url, size):
+    cli.compute_candidates(koji_client(url), 'bench-candidate',
+                           'bench-testing')
+
+
+def bench_list_old_candidates(url, size):
+    cli.compute_old_candidates(koji_client(url), 'bench-candidate',
+                               'bench-testing')
+
+
+def bench_promotion_report(url, size):
+    config = {'releases': {'bench': fake_hub.RELEASE_TAGS},
+              'releases_info': {'bench': {'name': 'bench'}}}
+    cli.compute_promotion_report(koji_client(url), config, 'bench')
+
+
+def _nvrs(size):
+    # latest build of a tenth of the packages, in candidate only
+    packages = max(size // BUILDS_PER_PACKAGE // 10, 1)
+    return ['python-bench{}-{}.0.0-1.el9s'.format(pkg,
+                                                  BUILDS_PER_PACKAGE - 1)
+            for pkg in range(packages)]
+
+
+def bench_tag_builds(url, size):
+    koji_client(url).tag_builds('testing', fake_hub.RELEASE_TAGS,
+                                _nvrs(size), TAGS_MAP)
+
+
+def bench_untag_builds(url, size):
+    koji_client(url).tag_builds('none', fake_hub.RELEASE_TAGS, _nvrs(size),
+                                TAGS_MAP)
+
+
+def bench_register_packages(url, size):
+    packages = ['python-bench{}'.format(pkg)
+                for pkg in range(size // BUILDS_PER_PACKAGE)]
+    koji_client(url).register_packages(fake_hub.RELEASE_TAGS, packages,
+                                       'bench')
+
+
+def _rdoinfo(size):
+    path = tempfile.mkdtemp(prefix='graffiti-bench-')
+    releases = max(size // 1000, 1)
+    with open(os.path.join(path, 'rdo.yml'), 'w') as info:
+        info.write('packages: []\nreleases:\n')
+        for release in range(releases):
+            info.write(RDOINFO_RELEASE.format(release))
+    return path
+
+
+CONFIG = {'koji': {'url': 'http://localhost', 'username': 'bench'},
+          'tags_maps': TAGS_MAP}
+
+
+def bench_config(url, size):
+    path = _rdoinfo(size)
+    try:
+        parse_config(CONFIG, path)
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_config_cached(url, size):
+    path = _rdoinfo(size)
+    config = dict(CONFIG, cache={'location': os.path.join(path, 'cache')})
+    try:
+        # warm up cache, only the second parse is measured
+        parse_config(config, path)
+        start = time.time()
+        parse_config(config, path)
+        return time.time() - start
+    finally:
+        shutil.rmtree(path)
+
+
+SCENARIOS = [('list-candidates', bench_list_candidates),
+             ('list-old-candidates', bench_list_old_candidates),
+             ('promotion-report', bench_promotion_report),
+             ('tag-builds', bench_tag_builds),
+             ('untag-builds', bench_untag_builds),
+             ('register-packages', bench_register_packages),
+             ('config', bench_config),
+             ('config-cached', bench_config_cached)]
+
+
+def run_scenario(hub, url, name, func, size):
+    hub.bench.reset()
+    tracemalloc.start()
+    start = time.time()
+    elapsed = func(url, size)
+    wall = time.time() - start if elapsed is None else elapsed
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = hub.bench.stats()
+    sizes = stats['multicall_sizes']
+    return {'scenario': name, 'size': size, 'wall': wall,
+            'requests': stats['requests'], 'calls': stats['calls'],
+            'bytes_in': stats['bytes_in'], 'bytes_out': stats['bytes_out'],
+            'max_multicall': max(sizes) if sizes else 0,
+            'peak_memory': peak}
+
+
+def report(results, baseline=None):
+    baseline = dict(((r['scenario'], r['size']), r)
+                    for r in baseline or [])
+    header = '{:<20} {:>7} {:>9} {:>8} {:>8} {:>10} {:>10} {:>9}'
+    print(header.format('scenario', 'size', 'wall(s)', 'requests', 'calls',
+                        'sent(KiB)', 'recv(KiB)', 'peak(MiB)'))
+    for r in results:
+        line = '{:<20} {:>7} {:>9.3f} {:>8} {:>8} {:>10.1f} {:>10.1f} ' \
+            '{:>9.1f}'.format(r['scenario'], r['size'], r['wall'],
+                              r['requests'], r['calls'],
+                              r['bytes_in'] / 1024.0,
+                              r['bytes_out'] / 1024.0,
+                              r['peak_memory'] / 1048576.0)
+        base = baseline.get((r['scenario'], r['size']))
+        if base and base['wall']:
+            line += '  {:+.0%} wall, {:+d} requests'.format(
+                r['wall'] / base['wall'] - 1,
+                r['requests'] - base['requests'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser('graffiti benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 5000, 20000],
+                        help='number of builds in the candidate tag')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added by the hub to every request')
+    parser.add_argument('--scenarios', nargs='+',
+                        choices=[name for name, _ in SCENARIOS],
+                        help='scenarios to run, all by default')
+    parser.add_argument('--json', help='write results to file')
+    parser.add_argument('--baseline', help='compare with results file')
+    args = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    hub_process = multiprocessing.Process(
+        target=fake_hub.serve, kwargs={'ready': ready.put})
+    hub_process.daemon = True
+    hub_process.start()
+    url = 'http://127.0.0.1:{}/kojihub'.format(ready.get(timeout=30))
+    hub = ServerProxy(url, allow_none=True)
+
+    results = []
+    try:
+        for size in args.sizes:
+            hub.bench.configure(size // BUILDS_PER_PACKAGE,
+                                BUILDS_PER_PACKAGE, args.latency)
+            for name, func in SCENARIOS:
+                if args.scenarios and name not in args.scenarios:
+                    continue
+                results.append(run_scenario(hub, url, name, func, size))
+    finally:
+        hub_process.terminate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
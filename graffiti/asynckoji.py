@@ -0,0 +1,158 @@
+"""graffiti.asynckoji handles concurrent koji read queries with asyncio
+
+Requests are sent concurrently over a bounded pool of anonymous koji
+sessions, each one keeping its HTTP connection alive between requests.
+"""
+import asyncio
+import functools
+from concurrent import futures
+import koji
+from graffiti import profiling
+from graffiti.kojiclient import all_builds, latest_builds
+from graffiti.snapshot import index_builds
+
+
+class AsyncKojiClient(object):
+    """asyncio counterpart of KojiClient read queries
+    At most concurrency requests are in flight, each one on a pooled
+    session. An optional TagCache persists tag IDs between runs and an
+    optional profiling.RPCStats records every RPC sent
+    """
+    def __init__(self, koji_url, concurrency=8, tag_cache=None, stats=None):
+        self.koji_url = koji_url
+        self.concurrency = concurrency
+        self.stats = stats
+        self.tag_cache = tag_cache
+        self._tag_index = tag_cache.load() if tag_cache else {}
+        self._sessions = []
+        self._executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+        self._loop = None
+        self._semaphore = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop workers and close pooled connections
+        """
+        self._executor.shutdown()
+        for session in self._sessions:
+            if session.rsession:
+                session.rsession.close()
+        self._sessions = []
+
+    def run(self, coroutine):
+        """Run a coroutine of this client from synchronous code
+        """
+        return asyncio.run(coroutine)
+
+    def _new_session(self):
+        session = koji.ClientSession(self.koji_url)
+        if self.stats:
+            profiling.instrument(session, self.stats)
+        return session
+
+    async def call(self, method, *args, **kwargs):
+        """Send a koji call on a pooled session
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            session = self._sessions.pop() if self._sessions \
+                else self._new_session()
+            try:
+                return await loop.run_in_executor(
+                    self._executor,
+                    functools.partial(getattr(session, method), *args,
+                                      **kwargs))
+            finally:
+                self._sessions.append(session)
+
+    async def _get_tag_id(self, tag):
+        """map tag name to tag ID in Koji
+        """
+        return (await self._get_tag_ids([tag]))[0]
+
+    async def _get_tag_ids(self, tags):
+        """map a list tag name to a list of corresponding tag ID in Koji
+        Unknown tag names are resolved concurrently
+        """
+        unknown = [tag for tag in set(tags) if tag not in self._tag_index]
+        if unknown:
+            results = await asyncio.gather(
+                *[self.call('getTag', tag) for tag in unknown])
+            resolved = False
+            for tag, result in zip(unknown, results):
+                if result:
+                    self._tag_index[tag] = result['id']
+                    resolved = True
+            if resolved and self.tag_cache:
+                self.tag_cache.store(self._tag_index)
+        return [self._tag_index.get(tag) for tag in tags]
+
+    async def retrieve_build_info(self, build):
+        """retrieve info about a build
+        """
+        return (await self.retrieve_builds_info([build]))[build]
+
+    async def _build_info(self, build):
+        buildinfo = await self.call('getBuild', build)
+        if not buildinfo:
+            return None
+        taglist = await self.call('listTags', build)
+        buildinfo['tags'] = [tag['name'] for tag in taglist]
+        return buildinfo
+
+    async def retrieve_builds_info(self, builds, tags=None):
+        """retrieve info about a list of builds concurrently
+        With tags, builds are first looked up in these tags listings and
+        only missing ones are queried
+        Returns a dict indexed by build, unknown builds map to None
+        """
+        if tags:
+            builds_info, missing = index_builds(
+                builds, await self.retrieve_tags_builds(tags))
+            builds_info.update(await self.retrieve_builds_info(missing))
+            return builds_info
+        builds = list(dict.fromkeys(builds))
+        results = await asyncio.gather(
+            *[self._build_info(build) for build in builds])
+        return dict(zip(builds, results))
+
+    async def _get_builds_from_tag(self, tag, packages=None, latest=False):
+        tag_id = await self._get_tag_id(tag)
+        if packages is None:
+            return await self.call('listTagged', tag_id, latest=latest)
+        results = await asyncio.gather(
+            *[self.call('listTagged', tag_id, latest=latest, package=package)
+              for package in packages])
+        return [b for result in results for b in result]
+
+    async def retrieve_builds(self, tag, packages=None, latest=False):
+        """retrieve latest builds in a tag
+        packages restricts the query to some packages, latest relies on
+        hub-side latest tagged builds
+        """
+        return latest_builds(await self._get_builds_from_tag(tag, packages,
+                                                             latest))
+
+    async def retrieve_all_builds(self, tag, packages=None):
+        """retrieve all builds in a tag
+        packages restricts the query to some packages
+        """
+        return all_builds(await self._get_builds_from_tag(tag, packages))
+
+    async def retrieve_tags_builds(self, tags, packages=None):
+        """retrieve all builds of several tags concurrently
+        Returns a dict indexed by tag of retrieve_all_builds results
+        """
+        tags = list(dict.fromkeys(tags))
+        await self._get_tag_ids(tags)
+        results = await asyncio.gather(
+            *[self.retrieve_all_builds(tag, packages) for tag in tags])
+        return dict(zip(tags, results))
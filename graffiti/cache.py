@@ -0,0 +1,106 @@
+"""graffiti.cache handles on-disk caching between runs
+"""
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import time
+
+
+def cache_file(location, kind, key, extension='json'):
+    """Compute cache file path for a kind of data and a key
+    """
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser(location),
+                        '{}-{}.{}'.format(kind, digest, extension))
+
+
+def load(path, ttl=None):
+    """Load cached data, returns None if missing, expired or corrupted
+    """
+    try:
+        with open(path, 'r') as cached:
+            entry = json.load(cached)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or 'data' not in entry:
+        return None
+    if ttl is not None and time.time() - entry.get('timestamp', 0) > ttl:
+        return None
+    return entry['data']
+
+
+def store(path, data):
+    """Atomically write data to cache
+    Returns False if data could not be cached, caching is best effort
+    """
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.graffiti-')
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'w') as cached:
+            json.dump({'timestamp': time.time(), 'data': data}, cached)
+        os.rename(tmp, path)
+    except (IOError, OSError, TypeError, ValueError):
+        os.unlink(tmp)
+        return False
+    return True
+
+
+def invalidate(path):
+    """Remove cached data
+    """
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class TagCache(object):
+    """Persist Koji tag name to tag ID mapping for a hub
+    Each tag ID expires ttl seconds after it was resolved
+    """
+    def __init__(self, location, koji_url, ttl=86400):
+        self.path = cache_file(location, 'tags', koji_url)
+        self.ttl = ttl
+
+    def _entries(self):
+        """Cached {tag: [tag ID, resolution timestamp]}
+        """
+        entries = load(self.path)
+        if not isinstance(entries, dict):
+            return {}
+        return dict((tag, entry) for tag, entry in entries.items()
+                    if isinstance(entry, list) and len(entry) == 2)
+
+    def load(self):
+        """Return cached mapping without expired tag IDs
+        """
+        now = time.time()
+        return dict((tag, tag_id)
+                    for tag, (tag_id, timestamp) in self._entries().items()
+                    if now - timestamp <= self.ttl)
+
+    def store(self, tag_ids):
+        """Save mapping, tag IDs already cached keep their resolution
+        timestamp
+        """
+        now = time.time()
+        cached = self._entries()
+        entries = {}
+        for tag, tag_id in tag_ids.items():
+            if tag in cached and cached[tag][0] == tag_id:
+                entries[tag] = cached[tag]
+            else:
+                entries[tag] = [tag_id, now]
+        store(self.path, entries)
+
+    def invalidate(self):
+        """Drop cached mapping
+        """
+        invalidate(self.path)
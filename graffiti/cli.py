@@ -1,26 +1,129 @@
 #!/usr/bin/env python
 """graffiti.cli handles user interaction
+
+Heavy modules (koji, distroinfo, yaml) are imported by the commands
+needing them to keep CLI startup fast.
 """
 from __future__ import print_function
 import argparse
+import collections
 import json
+import os
 import pprint
 import sys
+import threading
 import six
-import yaml
 from graffiti import __version__
-from graffiti.kojiclient import KojiClient
-from graffiti.config import parse_config_file, parse_command_file
+from graffiti.report import (
+    candidate_tags, compared_tags, compute_promotion_report, iter_candidates,
+    iter_old_candidates, plan_tag_commands, testing_tags)
+
+
+# koji RPC statistics collector, enabled by --profile or profiling hooks
+RPC_STATS = None
+
+
+def setup_profiling(config, args):
+    """Enable RPC statistics if requested
+    """
+    global RPC_STATS
+    hooks = (config.get('profiling') or {}).get('hooks', [])
+    if not args.profile and not args.profile_file and not hooks:
+        return None
+    from graffiti import profiling
+    RPC_STATS = profiling.RPCStats()
+    for hook in hooks:
+        RPC_STATS.add_hook(profiling.load_hook(hook))
+    return RPC_STATS
+
+
+def config_module():
+    """Import graffiti.config on demand, it loads yaml and distroinfo
+    """
+    from graffiti import config
+    return config
+
+
+def configure_caches(config):
+    """Return (tag cache, tag mirror) configured for the Koji hub, None
+    for disabled ones
+    """
+    if not config.get('cache'):
+        return None, None
+    from graffiti.cache import TagCache, cache_file
+    from graffiti.mirror import TagMirror
+    koji_url = config['koji']['url']
+    location = config['cache']['location']
+    tag_cache = TagCache(location, koji_url, config['cache']['tags_ttl'])
+    mirror = None
+    if config['cache'].get('mirror'):
+        mirror = TagMirror(cache_file(location, 'mirror', koji_url,
+                                      'sqlite'))
+    return tag_cache, mirror
 
 
 def configure_koji(config):
     """Configure a Koji object to be usable by commands
     """
+    from graffiti.kojiclient import KojiClient
     koji_url = config['koji']['url']
     client_cert = config['koji']['client_cert']
     clientca_cert = config['koji']['clientca_cert']
     serverca_cert = config['koji']['serverca_cert']
-    return KojiClient(koji_url, client_cert, clientca_cert, serverca_cert)
+    tag_cache, mirror = configure_caches(config)
+    return KojiClient(koji_url, client_cert, clientca_cert, serverca_cert,
+                      tag_cache=tag_cache,
+                      multicall_batch=config['koji'].get('multicall_batch'),
+                      multicall_jobs=config['koji'].get('multicall_jobs', 1),
+                      mirror=mirror, stats=RPC_STATS)
+
+
+def configure_async_koji(config):
+    """Configure an AsyncKojiClient when koji concurrency is set, None
+    otherwise
+    """
+    concurrency = config.get('koji', {}).get('concurrency')
+    if not concurrency:
+        return None
+    from graffiti.asynckoji import AsyncKojiClient
+    tag_cache, _ = configure_caches(config)
+    return AsyncKojiClient(config['koji']['url'], concurrency,
+                           tag_cache=tag_cache, stats=RPC_STATS)
+
+
+def prefetch_tags(config, tags, packages=None):
+    """Fetch tags concurrently into a TagSnapshot, None unless the
+    asyncio client is configured. Mirrored tags are not prefetched
+    """
+    if (config.get('cache') or {}).get('mirror'):
+        return None
+    client = configure_async_koji(config)
+    if client is None:
+        return None
+    from graffiti.snapshot import TagSnapshot
+    with client:
+        return TagSnapshot(client.run(client.retrieve_tags_builds(
+            tags, packages)))
+
+
+def load_snapshot(args):
+    """TagSnapshot given with --from-snapshot, None to query koji
+    """
+    if not getattr(args, 'from_snapshot', None):
+        return None
+    from graffiti.snapshot import TagSnapshot
+    return TagSnapshot.load(args.from_snapshot)
+
+
+def refresh_caches(config):
+    """Invalidate Koji related on-disk caches
+    """
+    tag_cache, mirror = configure_caches(config)
+    if tag_cache:
+        tag_cache.invalidate()
+    if mirror:
+        mirror.reset()
+        mirror.close()
 
 
 def version_cmd():
@@ -40,125 +143,505 @@ def format_json(missing):
 
 
 def format_yaml(missing):
+    import yaml
     print(yaml.dump(missing, default_flow_style=False))
 
 
+def stream_jsonl(builds, release, tag_from, tag_to, out=None, **fields):
+    """Write one JSON record per build as soon as it is available
+    builds is an iterable of (key, build) pairs, fields (report, change,
+    dist) are added to records when set
+    """
+    out = out or sys.stdout
+    for _, build in builds:
+        record = {'release': release, 'tag_from': tag_from,
+                  'tag_to': tag_to}
+        record.update((k, v) for k, v in six.iteritems(fields) if v)
+        record.update(build)
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+
 formatters = {'pretty': format_pretty,
               'yaml': format_yaml,
               'json': format_json}
 
 
-def list_candidates_cmd(config, args):
-    """Display candidates builds that are not tagged in testing
+def run_releases(config, releases, func, jobs=1, tags=None, packages=None,
+                 snapshot=None):
+    """Run func(koji, release) for every release and return results in
+    releases order. With jobs > 1, releases are processed by a pool of
+    workers, each one using its own Koji session.
+    tags(release) lists tags used by func, they are fetched concurrently
+    beforehand when the asyncio client is configured
+    With a loaded snapshot, koji is not queried at all
     """
-    koji = configure_koji(config)
-    for release in args.releases:
-        release_info = config['releases_info'][release]
-        tags = config['releases'][release]
-        if 'tags_map' in release_info.keys():
-            map_name = release_info['tags_map']
-        else:
-            map_name = 'unified_buildreqs'
-        if map_name == 'unified_buildreqs':
-            tag_from = tags[0]
-            tag_to = tags[1]
+    if snapshot is not None:
+        return [func(snapshot, release) for release in releases]
+    if tags is not None:
+        snapshot = prefetch_tags(config, [tag for release in releases
+                                          for tag in tags(release)],
+                                 packages)
+        if snapshot is not None:
+            return [func(snapshot, release) for release in releases]
+    if jobs <= 1 or len(releases) <= 1:
+        koji = configure_koji(config)
+        return [func(koji, release) for release in releases]
+    from concurrent import futures
+    sessions = threading.local()
+
+    def worker(release):
+        if not hasattr(sessions, 'koji'):
+            sessions.koji = configure_koji(config)
+        return func(sessions.koji, release)
+
+    workers = min(jobs, len(releases))
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(worker, releases))
+
+
+def output_releases(config, args, func, tags=None, packages=None):
+    """Display results of func(koji, release) for args.releases
+    func returns a (tag_from, tag_to, builds) tuple where builds is an
+    iterable of (key, build) pairs.
+    With jsonl format, builds are written as soon as they are known
+    tags and packages are passed to run_releases, tags are not prefetched
+    with --hub-latest which only fetches builds of changed packages
+    """
+    def worker(koji, release):
+        tag_from, tag_to, builds = func(koji, release)
+        return tag_from, tag_to, list(builds)
+
+    if getattr(args, 'hub_latest', False):
+        tags = None
+    results = run_releases(config, args.releases,
+                           worker if args.jobs > 1 else func, args.jobs,
+                           tags, packages, load_snapshot(args))
+    for release, (tag_from, tag_to, builds) in zip(args.releases, results):
+        if args.format == 'jsonl':
+            stream_jsonl(builds, release, tag_from, tag_to)
         else:
-            tag_from = tags[1]
-            tag_to = tags[2]
+            formatters[args.format](dict(builds))
+
+
+def candidates_query(config, args, packages=None):
+    """Return func(koji, release) computing list-candidates results of a
+    release, see output_releases
+    """
+    def candidates(koji, release):
+        tag_from, tag_to = candidate_tags(config, release)
         if args.old:
-            list_old_candidates(koji, tag_from, tag_to, formatter=args.format)
+            builds = iter_old_candidates(koji, tag_from, tag_to, packages)
         else:
-            list_candidates(koji, tag_from, tag_to, formatter=args.format)
+            builds = iter_candidates(koji, tag_from, tag_to, packages,
+                                     args.hub_latest)
+        return tag_from, tag_to, builds
+
+    return candidates
+
+
+def testing_query(config, args, packages=None):
+    """Return func(koji, release) computing list-testing results of a
+    release, see output_releases
+    """
+    def testing(koji, release):
+        tag_from, tag_to = testing_tags(config, release)
+        return tag_from, tag_to, iter_candidates(koji, tag_from, tag_to,
+                                                 packages, args.hub_latest)
+
+    return testing
+
+
+def report_query(config, args, packages=None):
+    """Return func(koji, release) computing promotion-report sections
+    of a release
+    """
+    def report(koji, release):
+        return compute_promotion_report(koji, config, release)
+
+    return report
+
+
+def list_candidates_cmd(config, args):
+    """Display candidates builds that are not tagged in testing
+    """
+    packages = selected_packages(args)
+    candidates = candidates_query(config, args, packages)
+    if args.watch:
+        output_changes(args, watch_releases(
+            configure_koji(config), config, args.releases, candidates,
+            args.interval))
+        return
+    output_releases(config, args, candidates,
+                    lambda release: candidate_tags(config, release),
+                    packages)
+
+
+def watch_releases(koji, config, releases, func, interval, sleep=None):
+    """Yields (release, tag_from, tag_to, added, removed) whenever the
+    result of func(koji, release) changes, see output_releases.
+    Tags are checked every interval seconds with their tagging history
+    since the last koji event, results are only recomputed for releases
+    whose tags changed. First results are reported as added.
+    """
+    import time
+    sleep = sleep or time.sleep
+    previous = {}
+    event = None
+    while True:
+        current = koji.last_event()
+        changed = releases
+        if current == event:
+            changed = []
+        elif event is not None:
+            tags = koji.changed_tags(
+                [tag for release in releases
+                 for tag in candidate_tags(config, release)], event)
+            changed = [release for release in releases
+                       if set(candidate_tags(config, release)) & set(tags)]
+        if changed:
+            koji.expire_mirror()
+        for release in changed:
+            tag_from, tag_to, builds = func(koji, release)
+            builds = dict(builds)
+            old = previous.get(release, {})
+            added = dict((k, b) for k, b in six.iteritems(builds)
+                         if old.get(k) != b)
+            removed = dict((k, b) for k, b in six.iteritems(old)
+                           if builds.get(k) != b)
+            previous[release] = builds
+            if added or removed:
+                yield release, tag_from, tag_to, added, removed
+        event = current
+        sleep(interval)
+
+
+def output_changes(args, changes):
+    """Display changes yielded by watch_releases as they happen
+    """
+    for release, tag_from, tag_to, added, removed in changes:
+        if args.format == 'jsonl':
+            stream_jsonl(six.iteritems(added), release, tag_from, tag_to,
+                         change='added')
+            stream_jsonl(six.iteritems(removed), release, tag_from, tag_to,
+                         change='removed')
+        else:
+            formatters[args.format]({'release': release, 'added': added,
+                                     'removed': removed})
+        sys.stdout.flush()
 
 
 def list_testing_cmd(config, args):
     """Display testing builds that are not tagged in release
     """
-    koji = configure_koji(config)
+    packages = selected_packages(args)
+    output_releases(config, args, testing_query(config, args, packages),
+                    lambda release: testing_tags(config, release), packages)
+
+
+# list commands supporting several CentOS releases:
+# (query, tags used by a release)
+DIST_QUERIES = {'list-candidates': (candidates_query, candidate_tags),
+                'list-testing': (testing_query, testing_tags),
+                'promotion-report': (report_query, compared_tags)}
+
+
+def dists_cmd(config, args):
+    """Run a list command for several CentOS releases at once
+    Tags of every dist are fetched once, concurrently and on a single
+    session, then results of each release are displayed keyed by dist
+    """
+    from graffiti.snapshot import TagSnapshot
+    query, release_tags = DIST_QUERIES[args.cmd]
+    packages = None
+    if args.cmd != 'promotion-report':
+        packages = selected_packages(args)
+    dist_name = config_module().dist_name
+    dist_configs = [(dist_name(centos_release),
+                     dict(config,
+                          releases=config['dists'][dist_name(centos_release)]))
+                    for centos_release in collections.OrderedDict.fromkeys(
+                        args.centos_release)]
+    tags = [tag for _, dist_config in dist_configs
+            for release in args.releases
+            for tag in release_tags(dist_config, release)]
+    snapshot = load_snapshot(args) or prefetch_tags(config, tags, packages)
+    if snapshot is None:
+        snapshot = TagSnapshot(configure_koji(config).retrieve_tags_builds(
+            tags, packages))
     for release in args.releases:
-        release_info = config['releases_info'][release]
-        tags = config['releases'][release]
-        if 'tags_map' in release_info.keys():
-            map_name = release_info['tags_map']
-        else:
-            map_name = 'unified_buildreqs'
-        if map_name == 'unified_buildreqs':
-            tag_from = tags[1]
-            tag_to = tags[2]
+        results = [(dist, query(dist_config, args, packages)(snapshot,
+                                                             release))
+                   for dist, dist_config in dist_configs]
+        output_dists(args, release, results)
+
+
+def output_dists(args, release, results):
+    """Display results of a release as computed by dists_cmd, results is
+    a list of (dist, query result)
+    """
+    if args.cmd == 'promotion-report':
+        if args.format == 'jsonl':
+            for dist, sections in results:
+                for section in sections:
+                    stream_jsonl(six.iteritems(section['builds']), release,
+                                 section['tag_from'], section['tag_to'],
+                                 report=section['report'], dist=dist)
         else:
-            tag_from = tags[2]
-            tag_to = tags[3]
-        list_candidates(koji, tag_from, tag_to, formatter=args.format)
+            formatters[args.format](dict(
+                (dist, dict((section['report'], section['builds'])
+                            for section in sections))
+                for dist, sections in results))
+    elif args.format == 'jsonl':
+        for dist, (tag_from, tag_to, builds) in results:
+            stream_jsonl(builds, release, tag_from, tag_to, dist=dist)
+    else:
+        formatters[args.format](dict((dist, dict(builds))
+                                     for dist, (_, _, builds) in results))
+
+
+def selected_packages(args):
+    """Packages given with --packages and --packages-file, None for all
+    """
+    if not args.packages and not args.packages_file:
+        return None
+    packages = list(args.packages or [])
+    if args.packages_file:
+        with open(args.packages_file) as packages_file:
+            packages.extend(line.split('#')[0].strip()
+                            for line in packages_file)
+    return [pkg for pkg in collections.OrderedDict.fromkeys(packages) if pkg]
+
+
+def compute_candidates(koji, tag_from, tag_to):
+    """Computes builds that in 'tag_from' but not in 'tag_to'
+    """
+    return dict(iter_candidates(koji, tag_from, tag_to))
 
 
 def list_candidates(koji, tag_from, tag_to, formatter='pretty'):
+    """Display builds that in 'tag_from' but not in 'tag_to'
+    """
+    formatters[formatter](compute_candidates(koji, tag_from, tag_to))
+
+
+def compute_old_candidates(koji, tag_from, tag_to):
     """Computes builds that in 'tag_from' but not in 'tag_to'
+       which are older that latest on in 'tag_to'
     """
-    candidates = koji.retrieve_builds(tag_from)
-    testing = koji.retrieve_builds(tag_to)
-    missing = {}
-    for k in six.iterkeys(candidates):
-        if k in testing:
-            if candidates[k]['id'] > testing[k]['id']:
-                missing[k] = candidates[k]
-        else:
-            missing[k] = candidates[k]
-    formatters[formatter](missing)
+    return dict(iter_old_candidates(koji, tag_from, tag_to))
 
 
 def list_old_candidates(koji, tag_from, tag_to, formatter='pretty'):
-    """Computes builds that in 'tag_from' but not in 'tag_to'
+    """Display builds that in 'tag_from' but not in 'tag_to'
        which are older that latest on in 'tag_to'
     """
-    candidates = koji.retrieve_all_builds(tag_from)
-    testing = koji.retrieve_all_builds(tag_to)
-    testing_latest = koji.retrieve_builds(tag_to)
-    missing = {}
-    for k in six.iterkeys(candidates):
-        name = candidates[k]['name']
-        # we may have packages in -candidate, for which there is no
-        # builds in -testing.
-        try:
-            if k not in testing and k < testing_latest[name]['id']:
-                missing[k] = candidates[k]
-        except KeyError:
-            pass
-    formatters[formatter](missing)
+    formatters[formatter](compute_old_candidates(koji, tag_from, tag_to))
+
+
+def promotion_report_cmd(config, args):
+    """Display candidates, old candidates and testing builds of releases
+    """
+    results = run_releases(config, args.releases,
+                           report_query(config, args), args.jobs,
+                           lambda release: compared_tags(config, release),
+                           snapshot=load_snapshot(args))
+    for release, sections in zip(args.releases, results):
+        if args.format == 'jsonl':
+            for section in sections:
+                stream_jsonl(six.iteritems(section['builds']), release,
+                             section['tag_from'], section['tag_to'],
+                             report=section['report'])
+        else:
+            formatters[args.format](
+                dict((section['report'], section['builds'])
+                     for section in sections))
+
+
+def format_plan(plan):
+    """Display planned tag operations
+    """
+    if not plan:
+        print("Nothing to do")
+    for operation in plan:
+        print("{} {} {}".format(operation.action, operation.tag,
+                                operation.build))
+
+
+def report_conflicts(conflicts):
+    """Warn about entries given several actions in command files
+    """
+    for release, name, actions in conflicts:
+        print("Warning: {} has conflicting entries in {}: {}, keeping {}"
+              .format(name, release,
+                      ', '.join('{} ({})'.format(action, filename)
+                                for action, filename in actions),
+                      actions[-1][0]), file=sys.stderr)
+
+
+def open_journal(args, digest):
+    """Journal of the command files, and operations left by the last run
+    when resuming. digest identifies the merged commands, the last run
+    must have been planned from the same ones
+    """
+    from graffiti.journal import Journal, journal_path
+    journal = Journal(journal_path(args.files))
+    if not args.resume:
+        return journal, None
+    remaining = journal.remaining(digest)
+    if remaining is None:
+        raise Exception("No journal to resume at %s" % journal.path)
+    return journal, remaining
 
 
 def tag_cmd(config, args):
-    """Tag builds from command file
+    """Tag builds from command files
+    Operations are journaled next to the command files, --resume runs
+    those not completed by the last run
     """
-    koji = configure_koji(config)
-    cmd_file = args.file
-    cmds = parse_command_file(cmd_file)
+    from graffiti.kojiclient import Operation
+    koji = load_snapshot(args) or configure_koji(config)
+    cfg = config_module()
+    cmds, conflicts = cfg.merge_tag_commands(
+        cfg.parse_command_files(args.files))
+    digest = cfg.commands_digest(cmds)
+    journal, remaining = open_journal(args, digest)
+    if remaining is not None:
+        plan = [Operation(*op) for op in remaining]
+    else:
+        report_conflicts(conflicts)
+        plan = plan_tag_commands(koji, config, cmds, args.tags_index)
+    if args.plan:
+        format_plan(plan)
+        return
+    if remaining is None:
+        journal.start(plan, digest)
+    koji.apply_plan(plan, journal, args.jobs)
+
+
+def register_pairs(config, cmds):
+    """(tag, package) pairs added and removed by merged register commands
+    Releases may share tags, pairs are deduplicated and a package both
+    added and removed in a tag is rejected
+    """
+    added = collections.OrderedDict()
+    removed = collections.OrderedDict()
     for release, dat in six.iteritems(cmds):
-        release_info = config['releases_info'][release]
         tags = config['releases'][release]
-        if 'tags_map' in release_info.keys():
-            map_name = release_info['tags_map']
-            tags_map = config['tags_maps'][map_name]
-        else:
-            tags_map = config['tags_maps']['unified_buildreqs']
-        for target, builds in six.iteritems(dat):
-            koji.tag_builds(target, tags, builds, tags_map)
+        added.update(((tag, pkg), None) for tag in tags
+                     for pkg in dat.get('add', []))
+        removed.update(((tag, pkg), None) for tag in tags
+                       for pkg in dat.get('remove', []))
+    conflicts = ['{} {}'.format(tag, pkg) for tag, pkg in removed
+                 if (tag, pkg) in added]
+    if conflicts:
+        raise Exception("Packages both added and removed: %s" %
+                        ', '.join(conflicts))
+    return list(added), list(removed)
 
 
 def register_cmd(config, args):
-    """Register packages in tags from command file
+    """Register packages in tags from command files
+    Only packages missing from or present in package lists are added or
+    removed, builds of removed packages are untagged
+    Operations are journaled next to the command files, --resume runs
+    those not completed by the last run
     """
     koji = configure_koji(config)
-    cmd_file = args.file
     username = config['koji']['username']
-    cmds = parse_command_file(cmd_file)
-    for release, dat in six.iteritems(cmds):
-        tags = config['releases'][release]
-        if 'add' in dat:
-            pkgs = dat['add']
-            koji.register_packages(tags, pkgs, username)
-        if 'remove' in dat:
-            pkgs = dat['remove']
-            koji.unregister_packages(tags, pkgs, True)
+    cfg = config_module()
+    cmds, conflicts = cfg.merge_register_commands(
+        cfg.parse_command_files(args.files))
+    digest = cfg.commands_digest(cmds)
+    journal, operations = open_journal(args, digest)
+    if operations is None:
+        report_conflicts(conflicts)
+        added, removed = register_pairs(config, cmds)
+        # only send changes to current package lists
+        added, removed = koji.plan_package_lists(added, removed)
+        operations = [('add', tag, pkg) for tag, pkg in added] + \
+            [('remove', tag, pkg) for tag, pkg in removed]
+        journal.start(operations, digest)
+    koji.update_package_lists(
+        [(tag, pkg) for action, tag, pkg in operations if action == 'add'],
+        [(tag, pkg) for action, tag, pkg in operations
+         if action == 'remove'], username, True, journal)
+
+
+def snapshot_cmd(config, args):
+    """Save all builds of release tags to a file, to run list commands and
+    tag plans offline with --from-snapshot
+    """
+    import time
+    from graffiti.snapshot import TagSnapshot
+    releases = args.releases or sorted(config['releases'])
+    unknown = [r for r in releases if r not in config['releases']]
+    if unknown:
+        raise Exception("Unknown releases %s" % ', '.join(unknown))
+    tags = list(collections.OrderedDict.fromkeys(
+        tag for release in releases for tag in config['releases'][release]))
+    koji = configure_koji(config)
+    event = koji.last_event()
+    snapshot = prefetch_tags(config, tags)
+    if snapshot is None:
+        snapshot = TagSnapshot(koji.retrieve_tags_builds(tags))
+    snapshot.event, snapshot.timestamp = event, time.time()
+    snapshot.dump(args.output)
+    print("Saved {} tags at koji event {} to {}".format(
+        len(tags), event, args.output))
+
+
+def serve_cmd(config, args):
+    """Serve queries over HTTP from tags kept in memory
+    """
+    from graffiti import server
+
+    def load_config():
+        return config_module().parse_config_file(
+            args.config_file, args.info_repo, args.centos_release,
+            args.info_file)
+
+    def config_key(config):
+        stat = os.stat(args.config_file)
+        rdoinfo_path = args.info_repo
+        if not rdoinfo_path and config:
+            rdoinfo_path = config['rdoinfo']['location']
+        if not rdoinfo_path:
+            return None
+        return (stat.st_mtime, stat.st_size,
+                config_module().rdoinfo_fingerprint(
+                    rdoinfo_path, args.centos_release, args.info_file))
+
+    service = server.GraffitiService(load_config, configure_koji,
+                                     args.releases, args.interval,
+                                     args.allow_tag, config_key)
+    print("graffiti serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve(service, args.host, args.port)
+    except KeyboardInterrupt:
+        pass
+
+
+def add_snapshot_argument(parser):
+    """Add option running a command against a saved snapshot
+    """
+    parser.add_argument('--from-snapshot', metavar='FILE',
+                        help='Use tags saved by graffiti snapshot instead '
+                        'of querying koji')
+
+
+def add_packages_arguments(parser):
+    """Add options restricting queries to some packages
+    """
+    parser.add_argument('--packages', nargs='+', metavar='PACKAGE',
+                        help='Only check these packages')
+    parser.add_argument('--packages-file',
+                        help='Only check packages listed in file, one per '
+                        'line')
+    parser.add_argument('--hub-latest', action='store_true',
+                        help='Rely on koji latest tagged builds, only '
+                        'packages whose latest builds differ between tags '
+                        'are fully fetched')
 
 
 def main():
@@ -169,11 +652,21 @@ def main():
                         help='config file. Default: config.yaml')
     parser.add_argument('--info-repo', help='Path to rdoinfo database. '
                         'Overrides value in config file.')
-    parser.add_argument('--centos-release', default='9s',
+    parser.add_argument('--centos-release', action='append',
                         choices=['9s', '10s'],
-                        help='CentOS Release to check.')
+                        help='CentOS Release to check. Default: 9s. '
+                        'list-candidates, list-testing and promotion-report '
+                        'accept it several times and display results keyed '
+                        'by dist.')
     parser.add_argument('--info-file', default='rdo.yml',
                         help='Main info file. Default: rdo.yml')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='Invalidate on-disk caches before running.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print koji RPC statistics at exit.')
+    parser.add_argument('--profile-file', metavar='FILE',
+                        help='Write koji RPC statistics as JSON to FILE at '
+                        'exit.')
     subparsers = parser.add_subparsers(dest='cmd')
 
     subparsers.add_parser('version', help='show version')  # NOQA
@@ -186,40 +679,145 @@ def main():
                                         candidate but not in testing tags',
                                         action='store_true')
     parser_list_candidates.add_argument('--format', help='Output format',
-                                        choices=['pretty', 'json', 'yaml'],
+                                        choices=['pretty', 'json', 'yaml',
+                                                 'jsonl'],
                                         default='pretty')
+    parser_list_candidates.add_argument('--jobs', type=int, default=1,
+                                        help='Number of releases to query\
+                                        concurrently. Default: 1')
+    parser_list_candidates.add_argument('--watch', action='store_true',
+                                        help='Keep running and only display\
+                                        added and removed candidates when\
+                                        tags change')
+    parser_list_candidates.add_argument('--interval', type=int, default=60,
+                                        metavar='SECONDS',
+                                        help='Seconds between tags checks\
+                                        with --watch. Default: 60')
+    add_packages_arguments(parser_list_candidates)
+    add_snapshot_argument(parser_list_candidates)
 
     parser_list_testing = subparsers.add_parser('list-testing',
                                                 help='list testing builds')
     parser_list_testing.add_argument('releases', nargs='+', help='releases')
     parser_list_testing.add_argument('--format', help='Output format',
-                                     choices=['pretty', 'json', 'yaml'],
+                                     choices=['pretty', 'json', 'yaml',
+                                              'jsonl'],
                                      default='pretty')
+    parser_list_testing.add_argument('--jobs', type=int, default=1,
+                                     help='Number of releases to query\
+                                     concurrently. Default: 1')
+    add_packages_arguments(parser_list_testing)
+    add_snapshot_argument(parser_list_testing)
+
+    parser_report = subparsers.add_parser('promotion-report',
+                                          help='list candidates, old \
+                                          candidates and testing builds')
+    parser_report.add_argument('releases', nargs='+', help='releases')
+    parser_report.add_argument('--format', help='Output format',
+                               choices=['pretty', 'json', 'yaml', 'jsonl'],
+                               default='pretty')
+    parser_report.add_argument('--jobs', type=int, default=1,
+                               help='Number of releases to query\
+                               concurrently. Default: 1')
+    add_snapshot_argument(parser_report)
 
     parser_tag = subparsers.add_parser('tag', help='tag builds')
-    parser_tag.add_argument('-f', required=True, dest='file',
-                            help='command file')
+    parser_tag.add_argument('-f', required=True, dest='files', nargs='+',
+                            help='command files or directories of command '
+                            'files, merged in a single run')
+    tag_mode = parser_tag.add_mutually_exclusive_group()
+    tag_mode.add_argument('--plan', action='store_true',
+                          help='only display tag operations to run')
+    tag_mode.add_argument('--apply', action='store_true',
+                          help='run tag operations (default)')
+    parser_tag.add_argument('--jobs', type=int, default=1,
+                            help='Number of concurrent koji sessions '
+                            'applying tag operations, operations of a build '
+                            'stay on one session. Default: 1')
+    parser_tag.add_argument('--tags-index', action='store_true',
+                            help='look builds up in the listings of the '
+                            'release tags instead of one by one, faster for '
+                            'large command files')
+    parser_tag.add_argument('--resume', action='store_true',
+                            help='run operations left by an interrupted run '
+                            'of the same command files')
+    parser_tag.add_argument('--from-snapshot', metavar='FILE',
+                            help='with --plan, use tags saved by graffiti '
+                            'snapshot instead of querying koji, builds in '
+                            'none of its tags are reported as missing')
     parser_register = subparsers.add_parser('register',
                                             help='register packages')
-    parser_register.add_argument('-f', required=True, dest='file',
-                                 help='command file')
+    parser_register.add_argument('-f', required=True, dest='files',
+                                 nargs='+', help='command files or '
+                                 'directories of command files, merged in a '
+                                 'single run')
+    parser_register.add_argument('--resume', action='store_true',
+                                 help='run operations left by an interrupted '
+                                 'run of the same command files')
+
+    parser_snapshot = subparsers.add_parser('snapshot',
+                                            help='save release tags to a '
+                                            'file for offline use')
+    parser_snapshot.add_argument('releases', nargs='*',
+                                 help='releases to save. Default: all')
+    parser_snapshot.add_argument('-o', '--output', required=True,
+                                 help='snapshot file to write')
+
+    parser_serve = subparsers.add_parser('serve',
+                                         help='serve queries over HTTP')
+    parser_serve.add_argument('releases', nargs='*',
+                              help='releases to serve. Default: all')
+    parser_serve.add_argument('--host', default='127.0.0.1',
+                              help='listening address. Default: 127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8080,
+                              help='listening port. Default: 8080')
+    parser_serve.add_argument('--interval', type=int, default=300,
+                              help='seconds between koji checks. '
+                              'Default: 300')
+    parser_serve.add_argument('--allow-tag', action='store_true',
+                              help='accept tag jobs on POST /tag')
 
     if len(sys.argv) == 1:
         sys.argv.append('--help')
     args = parser.parse_args(sys.argv[1:])
-    config = parse_config_file(args.config_file, args.info_repo,
-                               args.centos_release, args.info_file)
+    args.centos_release = args.centos_release or ['9s']
+    # commands requiring configuration
+    commands = {'list-candidates': list_candidates_cmd,
+                'list-testing': list_testing_cmd,
+                'promotion-report': promotion_report_cmd,
+                'tag': tag_cmd,
+                'register': register_cmd,
+                'snapshot': snapshot_cmd,
+                'serve': serve_cmd}
 
     if args.cmd == 'version':
         version_cmd()
-    elif args.cmd == 'list-candidates':
-        list_candidates_cmd(config, args)
-    elif args.cmd == 'list-testing':
-        list_testing_cmd(config, args)
-    elif args.cmd == 'tag':
-        tag_cmd(config, args)
-    elif args.cmd == 'register':
-        register_cmd(config, args)
+    elif args.cmd in commands:
+        command = commands[args.cmd]
+        if len(set(args.centos_release)) > 1:
+            if args.cmd not in DIST_QUERIES or getattr(args, 'watch', None):
+                parser.error('several --centos-release are only supported by '
+                             'list-candidates, list-testing and '
+                             'promotion-report')
+            command = dists_cmd
+        if getattr(args, 'from_snapshot', None) and (
+                getattr(args, 'watch', None) or
+                (args.cmd == 'tag' and (not args.plan or args.resume))):
+            parser.error('--from-snapshot is only supported without --watch '
+                         'and by tag --plan')
+        config = config_module().parse_config_file(
+            args.config_file, args.info_repo, args.centos_release,
+            args.info_file, args.refresh_cache)
+        if args.refresh_cache:
+            refresh_caches(config)
+        stats = setup_profiling(config, args)
+        try:
+            command(config, args)
+        finally:
+            if stats and args.profile_file:
+                stats.dump(args.profile_file, args.cmd)
+            if stats and args.profile:
+                stats.report(args.cmd)
     else:
         print("Unknown command")
     sys.exit(0)
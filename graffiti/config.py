@@ -1,34 +1,41 @@
 """graffiti.config handles config and command files parsing
 """
+import collections
+import hashlib
+import json
+import os
 import os.path
 import yaml
 
-from distroinfo import info as dinfo
+from graffiti import cache
 
 
 def parse_config_file(filename, rdoinfo_path=None, centos_release='9s',
-                      info_file='rdo.yml'):
+                      info_file='rdo.yml', refresh_cache=False):
     """Parse graffiti config file
     """
     with open(filename, 'rb') as cfg_file:
         data = yaml.safe_load(cfg_file)
-        info = parse_config(data, rdoinfo_path, centos_release, info_file)
+        info = parse_config(data, rdoinfo_path, centos_release, info_file,
+                            refresh_cache)
         return info
     return None
 
 
 def parse_config(data, rdoinfo_path=None, centos_release='9s',
-                 info_file='rdo.yml'):
+                 info_file='rdo.yml', refresh_cache=False):
     """Config file parser
     """
     info = {}
     if not rdoinfo_path:
         info['rdoinfo'] = parse_rdoinfo(data)
         rdoinfo_path = info['rdoinfo']['location']
-    info['releases'] = parse_releases(rdoinfo_path, centos_release, info_file)
-    info['releases_info'] = parse_releases_info(rdoinfo_path, info_file)
+    info['cache'] = parse_cache(data, refresh_cache)
+    info.update(parse_rdoinfo_releases(rdoinfo_path, centos_release,
+                                       info_file, info['cache']))
     info['koji'] = parse_koji(data)
     info['tags_maps'] = data['tags_maps']
+    info['profiling'] = data.get('profiling')
     return info
 
 
@@ -39,14 +46,109 @@ def parse_rdoinfo(data):
     return {'location': location}
 
 
-def parse_releases(rdoinfo_path, centos_release='9s', info_file='rdo.yml'):
-    """Parse config release section to extract buildsys-tags
+def dist_name(centos_release):
+    """rdoinfo dist of a CentOS release
+    """
+    return "el{0}".format(centos_release)
+
+
+def parse_rdoinfo_releases(rdoinfo_path, centos_release='9s',
+                           info_file='rdo.yml', cache_info=None):
+    """Parse rdoinfo once to extract releases and their buildsys-tags
+    centos_release may be a list: releases of every dist are in 'dists',
+    'releases' being those of the first one
+    Result is cached on disk when cache is enabled, keyed on rdoinfo state
     """
-    data = dinfo.DistroInfo(info_files=info_file,
+    if isinstance(centos_release, (list, tuple)):
+        centos_releases = list(centos_release)
+    else:
+        centos_releases = [centos_release]
+    cache_path = None
+    if cache_info:
+        key = rdoinfo_fingerprint(rdoinfo_path, centos_releases, info_file)
+        cache_path = cache.cache_file(cache_info['location'], 'rdoinfo', key)
+        if cache_info.get('refresh'):
+            cache.invalidate(cache_path)
+        else:
+            cached = cache.load(cache_path)
+            if cached is not None:
+                return cached
+    data = load_rdoinfo(rdoinfo_path, info_file)
+    dists = dict((dist_name(release),
+                  parse_releases(rdoinfo_path, release, info_file, data))
+                 for release in centos_releases)
+    info = {'releases': dists[dist_name(centos_releases[0])],
+            'dists': dists,
+            'releases_info': parse_releases_info(rdoinfo_path, info_file,
+                                                 data)}
+    if cache_path:
+        cache.store(cache_path, info)
+    return info
+
+
+def load_rdoinfo(rdoinfo_path, info_file='rdo.yml'):
+    """Load and merge rdoinfo database
+    """
+    # distroinfo is slow to import, only load it when needed
+    from distroinfo import info as dinfo
+    return dinfo.DistroInfo(info_files=info_file,
                             local_info=rdoinfo_path).get_info()
+
+
+def rdoinfo_fingerprint(rdoinfo_path, centos_release='9s',
+                        info_file='rdo.yml'):
+    """Compute a key identifying rdoinfo state from its git commit
+    and info files metadata
+    """
+    rdoinfo_path = os.path.abspath(os.path.expanduser(rdoinfo_path))
+    digest = hashlib.sha1()
+    for item in (rdoinfo_path, info_file, centos_release,
+                 _git_head(rdoinfo_path)):
+        digest.update(repr(item).encode('utf-8'))
+    for root, dirs, files in os.walk(rdoinfo_path):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in sorted(files):
+            if not name.endswith(('.yml', '.yaml')):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(repr((os.path.relpath(path, rdoinfo_path),
+                                stat.st_mtime, stat.st_size)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _git_head(path):
+    """Return commit checked out in a git repository, None if not a git repo
+    """
+    git_dir = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as head:
+            ref = head.read().strip()
+        if not ref.startswith('ref: '):
+            return ref
+        ref = ref[len('ref: '):]
+        ref_file = os.path.join(git_dir, ref)
+        if os.path.exists(ref_file):
+            with open(ref_file) as commit:
+                return commit.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs')) as packed:
+            for line in packed:
+                if line.rstrip().endswith(' ' + ref):
+                    return line.split()[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def parse_releases(rdoinfo_path, centos_release='9s', info_file='rdo.yml',
+                   data=None):
+    """Parse config release section to extract buildsys-tags
+    """
+    if data is None:
+        data = load_rdoinfo(rdoinfo_path, info_file)
     releases = data['releases']
     rel = {}
-    dist_tag = "el{0}".format(centos_release)
+    dist_tag = dist_name(centos_release)
     for release in releases:
         release_name = release['name']
         filter_repos = [dist for dist in release['repos'] if
@@ -59,11 +161,11 @@ def parse_releases(rdoinfo_path, centos_release='9s', info_file='rdo.yml'):
     return rel
 
 
-def parse_releases_info(rdoinfo_path, info_file='rdo.yml'):
+def parse_releases_info(rdoinfo_path, info_file='rdo.yml', data=None):
     """Parse config release section
     """
-    data = dinfo.DistroInfo(info_files=info_file,
-                            local_info=rdoinfo_path).get_info()
+    if data is None:
+        data = load_rdoinfo(rdoinfo_path, info_file)
     releases = data['releases']
     releases_info = {}
     for release in releases:
@@ -78,14 +180,30 @@ def parse_koji(data):
     """
     srv = {}
     koji = data['koji']
-    srv['username'] = koji['username']
+    srv['username'] = koji.get('username')
     srv['url'] = koji['url']
-    srv['client_cert'] = os.path.expanduser(koji['client_cert'])
-    srv['clientca_cert'] = os.path.expanduser(koji['clientca_cert'])
-    srv['serverca_cert'] = os.path.expanduser(koji['serverca_cert'])
+    # certificates are optional, read-only commands run anonymously
+    for cert in ('client_cert', 'clientca_cert', 'serverca_cert'):
+        srv[cert] = koji.get(cert) and os.path.expanduser(koji[cert])
+    srv['multicall_batch'] = koji.get('multicall_batch', 500)
+    srv['multicall_jobs'] = koji.get('multicall_jobs', 1)
+    # concurrent read requests, enables the asyncio client when set
+    srv['concurrency'] = koji.get('concurrency')
     return srv
 
 
+def parse_cache(data, refresh=False):
+    """Parse optional config cache section, None if caching is disabled
+    """
+    cache_info = data.get('cache')
+    if not cache_info:
+        return None
+    return {'location': os.path.expanduser(cache_info['location']),
+            'tags_ttl': cache_info.get('tags_ttl', 86400),
+            'mirror': cache_info.get('mirror', False),
+            'refresh': refresh}
+
+
 def parse_command_file(filename):
     """Parse command files
     """
@@ -93,3 +211,86 @@ def parse_command_file(filename):
         data = yaml.safe_load(cmd_file)
         return data
     return {}
+
+
+def command_files(paths):
+    """Expand directories to the YAML files they contain, sorted by name
+    A file given several times is only kept once, at its first position
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if name.endswith(('.yaml', '.yml')))
+        else:
+            files.append(path)
+    unique = collections.OrderedDict()
+    for filename in files:
+        unique.setdefault(os.path.abspath(filename), filename)
+    return list(unique.values())
+
+
+def parse_command_files(paths):
+    """Parse command files and directories of command files
+    Returns a list of (filename, commands) in processing order
+    """
+    return [(filename, parse_command_file(filename) or {})
+            for filename in command_files(paths)]
+
+
+def _merge_entries(entries):
+    """Keep the last action of each (release, name) in entries order
+    entries are (release, action, name, filename) tuples
+    Returns ({release: {action: [names]}}, conflicts) where conflicts
+    lists (release, name, [(action, filename)]) of names given several
+    actions
+    """
+    seen = collections.OrderedDict()
+    for release, action, name, filename in entries:
+        seen.setdefault((release, name), []).append((action, filename))
+    merged = {}
+    conflicts = []
+    for (release, name), actions in seen.items():
+        action = actions[-1][0]
+        merged.setdefault(release, {}).setdefault(action, []).append(name)
+        if len(set(a for a, _ in actions)) > 1:
+            conflicts.append((release, name, actions))
+    return merged, conflicts
+
+
+def merge_tag_commands(parsed):
+    """Merge tag command files into a single {release: {target: [builds]}}
+    Duplicates are dropped, a build given several targets in a release
+    keeps the last one
+    Returns (commands, conflicts), see _merge_entries
+    """
+    return _merge_entries(
+        (release, target, build, filename)
+        for filename, cmds in parsed
+        for release, targets in cmds.items()
+        for target, builds in (targets or {}).items()
+        for build in builds or [])
+
+
+def merge_register_commands(parsed):
+    """Merge register command files into {release: {'add': [packages],
+    'remove': [packages]}}
+    Duplicates are dropped, a package both added and removed keeps the
+    last action, removals coming after additions within a file
+    Returns (commands, conflicts), see _merge_entries
+    """
+    return _merge_entries(
+        (release, action, package, filename)
+        for filename, cmds in parsed
+        for release, actions in cmds.items()
+        for action in ('add', 'remove')
+        for package in (actions or {}).get(action) or [])
+
+
+def commands_digest(cmds):
+    """Digest of merged commands, identifies the commands a journaled run
+    was planned from
+    """
+    return hashlib.sha1(json.dumps(cmds, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
@@ -0,0 +1,93 @@
+"""graffiti.journal records planned and completed koji operations
+
+A journal is an append-only JSON lines file: a run writes the operations
+it plans, then every batch of operations once completed, so that an
+interrupted run can be resumed without planning or sending them again.
+Planned operations are recorded with a digest of the commands they come
+from, a run is only resumed for the same commands.
+"""
+import json
+import os
+import os.path
+import threading
+
+
+def journal_path(paths):
+    """Journal file next to the first command file or directory
+    """
+    return paths[0].rstrip(os.sep) + '.journal'
+
+
+class Journal(object):
+    """Operations of the last run are lists of JSON values, usually
+    (action, tag, name)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Return (planned, done) operations of the last run, planned is
+        None if no run was recorded
+        """
+        planned, done, _ = self._load()
+        return planned, done
+
+    def _load(self):
+        planned, done, digest = None, set(), None
+        if not os.path.exists(self.path):
+            return planned, done, digest
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line may be truncated by an interruption
+                    continue
+                if 'planned' in record:
+                    planned = [tuple(op) for op in record['planned']]
+                    digest = record.get('digest')
+                    done = set()
+                else:
+                    done.update(tuple(op) for op in record['done'])
+        return planned, done, digest
+
+    def remaining(self, digest=None):
+        """Planned operations of the last run not completed yet, None if
+        no run was recorded
+        With digest, the last run must have been planned from the same
+        commands
+        """
+        planned, done, planned_digest = self._load()
+        if planned is None:
+            return None
+        if digest is not None and digest != planned_digest:
+            raise Exception("Commands changed since the journaled run at %s"
+                            % self.path)
+        return [op for op in planned if op not in done]
+
+    def start(self, operations, digest=None):
+        """Record operations planned by a new run, replacing last run
+        digest identifies the commands operations are planned from
+        """
+        record = {'planned': [list(op) for op in operations]}
+        if digest is not None:
+            record['digest'] = digest
+        with self.lock:
+            with open(self.path, 'w') as journal:
+                self._write(journal, record)
+
+    def record(self, operations):
+        """Record completed operations
+        """
+        if not operations:
+            return
+        with self.lock:
+            with open(self.path, 'a') as journal:
+                self._write(journal, {'done': [list(op)
+                                               for op in operations]})
+
+    def _write(self, journal, record):
+        journal.write(json.dumps(record) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
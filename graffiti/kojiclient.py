@@ -2,138 +2,443 @@
 """
 import collections
 import copy
+from concurrent import futures
 import koji
+import six
+from graffiti import multicall
+from graffiti import profiling
+from graffiti.snapshot import TagBuilds
+from graffiti.snapshot import index_builds
+
+
+TARGETS = ['none', 'el7-build', 'el8-build', 'el9s-build', 'el10s-build',
+           'candidate', 'testing', 'release']
+
+# a single tag or untag of a build
+Operation = collections.namedtuple('Operation', ['action', 'tag', 'build'])
 
 
 class KojiClient(object):
     """Centralize interaction with Koji
     """
+    # maximum number of calls sent in a single multicall request
+    multicall_batch = 500
+
     def __init__(self, koji_url,
-                 client_cert, clientca_cert, serverca_cert):
+                 client_cert=None, clientca_cert=None, serverca_cert=None,
+                 tag_cache=None, multicall_batch=None, multicall_jobs=1,
+                 mirror=None, stats=None):
         """Setup Koji client session
-        Requires server urls and path to certificates
+        Requires server url, certificates are only needed by write
+        operations: session is anonymous until the first one
+        An optional TagCache persists tag IDs between runs
+        Multicalls are split in batches of multicall_batch calls, up to
+        multicall_jobs batches are sent concurrently
+        An optional TagMirror serves tags contents from a local copy
+        updated from koji tagging history
+        An optional profiling.RPCStats records every RPC sent
         """
-        self.kojiclient = koji.ClientSession(koji_url)
-        self.kojiclient.ssl_login(client_cert, clientca_cert, serverca_cert)
+        self.koji_url = koji_url
+        self.stats = stats
+        self.kojiclient = self._new_session()
+        self._certs = (client_cert, clientca_cert, serverca_cert)
+        self.authenticated = False
+        if multicall_batch:
+            self.multicall_batch = multicall_batch
+        self.multicall_jobs = multicall_jobs
+        self.mirror = mirror
+        self._mirrored = set()
+        self.tag_cache = tag_cache
+        self._tag_index = tag_cache.load() if tag_cache else {}
+
+    def invalidate_tag_index(self):
+        """forget known tag IDs, including the on-disk cache
+        """
+        self._tag_index = {}
+        if self.tag_cache:
+            self.tag_cache.invalidate()
+
+    def _new_session(self, session=None):
+        """Create an anonymous session or instrument an existing one
+        """
+        if session is None:
+            session = koji.ClientSession(self.koji_url)
+        if self.stats:
+            profiling.instrument(session, self.stats)
+        return session
+
+    def login(self):
+        """Authenticate session, done once before the first write
+        """
+        if self.authenticated:
+            return
+        if not self._certs[0]:
+            raise Exception("Koji client certificate required for write "
+                            "operations")
+        self.kojiclient.ssl_login(*self._certs)
+        self.authenticated = True
+
+    def _multicall(self, calls, write=False, on_batch=None):
+        """Execute a list of multicall.Call in bounded batches
+        Write calls require an authenticated session, concurrent batches
+        then run on subsessions, otherwise on anonymous sessions
+        on_batch is passed to multicall.execute
+        Returns a MulticallReport
+        """
+        calls = list(calls)
+        if not calls:
+            return multicall.MulticallReport([], [])
+        if write:
+            self.login()
+
+            def new_session():
+                return self._new_session(self.kojiclient.subsession())
+        else:
+            new_session = self._new_session
+        return multicall.execute(self.kojiclient, calls,
+                                 self.multicall_batch, self.multicall_jobs,
+                                 new_session, on_batch)
 
     def _get_tag_id(self, tag):
         """map tag name to tag ID in Koji
         """
-        tags = [x['id'] for x in self.kojiclient.listTags()
-                if x['name'] == tag]
-        return tags[0] if len(tags) else None
+        return self._get_tag_ids([tag])[0]
 
     def _get_tag_ids(self, tags):
         """map a list tag name to a list of corresponding tag ID in Koji
+        Unknown tag names are resolved in a single getTag multicall
         """
-        tag_ids = [self._get_tag_id(tag) for tag in tags]
-        return tag_ids if len(tag_ids) else []
+        unknown = [tag for tag in set(tags) if tag not in self._tag_index]
+        if unknown:
+            results = self._multicall(
+                [multicall.call('getTag', tag) for tag in unknown]
+            ).check().results
+            resolved = False
+            for tag, result in zip(unknown, results):
+                if result:
+                    self._tag_index[tag] = result['id']
+                    resolved = True
+            if resolved and self.tag_cache:
+                self.tag_cache.store(self._tag_index)
+        return [self._tag_index.get(tag) for tag in tags]
 
     def retrieve_build_info(self, build):
         """retrieve info about a build
         """
-        build = self.kojiclient.getBuild(build)
-        taglist = []
-        if build:
-            for tag in self.kojiclient.listTags(build):
-                taglist.append(tag['name'])
-            build['tags'] = taglist
-        return build
+        return self.retrieve_builds_info([build])[build]
+
+    def retrieve_builds_info(self, builds, tags=None):
+        """retrieve info about a list of builds using batched multicalls
+        With tags, builds are first looked up in these tags listings, see
+        index_builds, and only missing ones are queried
+        Returns a dict indexed by build, unknown builds map to None
+        """
+        if tags:
+            builds_info, missing = index_builds(
+                builds, self.retrieve_tags_builds(tags))
+            builds_info.update(self.retrieve_builds_info(missing))
+            return builds_info
+        builds = list(collections.OrderedDict.fromkeys(builds))
+        calls = []
+        for build in builds:
+            calls.append(multicall.call('getBuild', build))
+            calls.append(multicall.call('listTags', build))
+        report = self._multicall(calls)
+        results = report.entries
+        # listTags fails for unknown builds, getBuild faults are errors
+        multicall.MulticallReport(calls[::2], results[::2]).check()
+        builds_info = {}
+        for i, build in enumerate(builds):
+            buildinfo, taglist = results[2 * i], results[2 * i + 1]
+            if not buildinfo[0]:
+                builds_info[build] = None
+                continue
+            if isinstance(taglist, dict):
+                raise Exception("Unable to list tags for build %s: %s" %
+                                (build, taglist['faultString']))
+            buildinfo = buildinfo[0]
+            buildinfo['tags'] = [tag['name'] for tag in taglist[0]]
+            builds_info[build] = buildinfo
+        return builds_info
 
-    def _get_builds_from_tag(self, tag):
+    def sync_mirror(self, tags):
+        """Bring local mirror of tags up to date
+        Tags never mirrored are fully listed, others only fetch tagging
+        history since their last known event, all in a single multicall
+        """
+        tags = [tag for tag in collections.OrderedDict.fromkeys(tags)
+                if tag not in self._mirrored]
+        if not tags:
+            return
+        tag_ids = self._get_tag_ids(tags)
+        events = [self.mirror.last_event(tag) for tag in tags]
+        calls = [multicall.call('getLastEvent')]
+        for tag_id, event in zip(tag_ids, events):
+            if event is None:
+                calls.append(multicall.call('listTagged', tag_id,
+                                            latest=False))
+            else:
+                calls.append(multicall.call('queryHistory',
+                                            tables=['tag_listing'],
+                                            tag=tag_id, afterEvent=event))
+        results = self._multicall(calls).check().results
+        # changes racing with this sync are replayed next time
+        last_event = results[0]['id']
+        for tag, event, result in zip(tags, events, results[1:]):
+            if event is None:
+                self.mirror.replace(tag, result, last_event)
+            else:
+                self.mirror.apply_history(tag, result['tag_listing'],
+                                          last_event)
+            self._mirrored.add(tag)
+
+    def expire_mirror(self):
+        """sync mirrored tags again on next query
+        """
+        self._mirrored = set()
+
+    def last_event(self):
+        """ID of the last koji event, changes whenever a tag is modified
+        """
+        return self.kojiclient.getLastEvent()['id']
+
+    def changed_tags(self, tags, event):
+        """tags whose builds changed after event, checked with a single
+        queryHistory multicall
+        """
+        tags = list(collections.OrderedDict.fromkeys(tags))
+        results = self._multicall(
+            [multicall.call('queryHistory', tables=['tag_listing'],
+                            tag=tag_id, afterEvent=event)
+             for tag_id in self._get_tag_ids(tags)]).check().results
+        return [tag for tag, result in zip(tags, results)
+                if result['tag_listing']]
+
+    def _get_builds_from_tag(self, tag, packages=None, latest=False):
+        if packages is not None or latest:
+            return self._get_builds_from_tags([tag], packages, latest)[tag]
+        if self.mirror:
+            self.sync_mirror([tag])
+            return self.mirror.builds(tag)
         tag_id = self._get_tag_id(tag)
         return self.kojiclient.listTagged(tag_id, latest=False)
 
-    def retrieve_builds(self, tag):
+    def _get_builds_from_tags(self, tags, packages=None, latest=False):
+        """retrieve listTagged results for several tags in one multicall
+        When packages are given, only their builds are queried, with a
+        call per tag and package
+        With latest, the hub only returns latest tagged build of each
+        package, which is not always the latest build
+        """
+        tags = list(collections.OrderedDict.fromkeys(tags))
+        if self.mirror:
+            self.sync_mirror(tags)
+            wanted = set(packages) if packages is not None else None
+            return dict((tag, [b for b in self.mirror.builds(tag)
+                               if wanted is None or
+                               b['package_name'] in wanted])
+                        for tag in tags)
+        tag_ids = self._get_tag_ids(tags)
+        if packages is None:
+            results = self._multicall(
+                [multicall.call('listTagged', tag_id, latest=latest)
+                 for tag_id in tag_ids]).check().results
+            return dict(zip(tags, results))
+        packages = list(packages)
+        results = self._multicall(
+            [multicall.call('listTagged', tag_id, latest=latest,
+                            package=package)
+             for tag_id in tag_ids for package in packages]).check().results
+        count = len(packages)
+        return dict((tag, [b for result in results[i * count:(i + 1) * count]
+                           for b in result])
+                    for i, tag in enumerate(tags))
+
+    def retrieve_builds(self, tag, packages=None, latest=False):
         """retrieve latest builds in a tag
+        packages restricts the query to some packages, latest relies on
+        hub-side latest tagged builds, see _get_builds_from_tags
         """
-        builds = self._get_builds_from_tag(tag)
-        # filter out older builds
-        # Koji listTagged call returns latest modified build *not* latest build
-        # so we retrieve all builds and compaire build id to keep only latest
-        latest_builds = {}
-        for b in builds:
-            package_name = b['package_name']
-            build_id = b['build_id']
-            if package_name in latest_builds:
-                b2 = latest_builds[package_name]
-                if b2['id'] > build_id:
-                    continue
-            latest_builds[package_name] = {'name': package_name,
-                                           'id': build_id,
-                                           'nvr': b['nvr']}
-        return latest_builds
-
-    def retrieve_all_builds(self, tag):
+        return latest_builds(self._get_builds_from_tag(tag, packages,
+                                                       latest))
+
+    def retrieve_all_builds(self, tag, packages=None):
         """retrieve all builds in a tag
+        packages restricts the query to some packages
         """
-        builds = self._get_builds_from_tag(tag)
-        all_builds = {}
-        for b in builds:
-            package_name = b['package_name']
-            build_id = b['build_id']
-            all_builds[build_id] = {'name': package_name,
-                                    'id': build_id,
-                                    'nvr': b['nvr']}
-        return all_builds
+        return all_builds(self._get_builds_from_tag(tag, packages))
+
+    def retrieve_tags_builds(self, tags, packages=None):
+        """retrieve all builds of several tags, each tag is fetched once
+        packages restricts the query to some packages
+        Returns a dict indexed by tag of retrieve_all_builds results
+        """
+        return dict((tag, all_builds(builds)) for tag, builds in
+                    six.iteritems(self._get_builds_from_tags(tags,
+                                                             packages)))
 
     def register_packages(self, tags, pkgs, username):
         """Register packages to a list of tags
+        Only packages missing from tags package lists are added
         Username is Koji owner
         """
-        if not isinstance(tags, collections.Iterable):
+        if isinstance(tags, six.string_types):
             tags = [tags]
-        tag_ids = self._get_tag_ids(tags)
-        self.kojiclient.multicall = True
-        for tag_id in tag_ids:
-            for pkg in pkgs:
-                self.kojiclient.packageListAdd(tag_id, pkg, owner=username)
-        self.kojiclient.multiCall(strict=True)
+        added, _ = self.plan_package_lists(
+            [(tag, pkg) for tag in tags for pkg in pkgs], [])
+        return self.update_package_lists(added, [], username)
 
     def unregister_packages(self, tags, pkgs, force=False):
         """Unregister packages to a list of tags
+        Only packages in tags package lists are removed, with force their
+        builds are untagged first
         """
-        # FIXME: remove tagged builds if force set to True
-        if not isinstance(tags, collections.Iterable):
+        if isinstance(tags, six.string_types):
             tags = [tags]
-        tag_ids = self._get_tag_ids(tags)
-        self.kojiclient.multicall = True
-        for tag_id in tag_ids:
-            for pkg in pkgs:
-                self.kojiclient.packageListRemove(tag_id, pkg, force)
-        self.kojiclient.multiCall(strict=True)
+        _, removed = self.plan_package_lists(
+            [], [(tag, pkg) for tag in tags for pkg in pkgs])
+        return self.update_package_lists([], removed, None, force)
 
-    def _apply_tags(self, builds, tags, added_tags):
-        """ Apply tags in a koji instance for a build.
-            params:
-             - builds: list of nvrs for the builds to be tagged.
-             - tags: list of tags in a release
-             - added_tags: tags required for a build in
-               the given release
+    def retrieve_package_lists(self, tags):
+        """retrieve packages listed in tags, without inherited ones, with
+        a single listPackages multicall
+        Returns a dict of sets of package names indexed by tag
         """
+        tags = list(collections.OrderedDict.fromkeys(tags))
+        results = self._multicall(
+            [multicall.call('listPackages', tagID=tag_id, inherited=False)
+             for tag_id in self._get_tag_ids(tags)]).check().results
+        return dict((tag, set(pkg['package_name'] for pkg in result))
+                    for tag, result in zip(tags, results))
 
-        tag_ids = self._get_tag_ids(tags)
-        remove_tags = copy.copy(tag_ids)
-
-        for added in added_tags:
-            add_builds = []
-            remove_tags.remove(tag_ids[added])
-            for build in builds:
-                buildinfo = self.retrieve_build_info(build)
-                if not buildinfo:
-                    raise Exception("Build %s does not exist" % build)
-                build_tags = buildinfo['tags']
-                if tags[added] not in build_tags:
-                    add_builds.append(build)
-            self.kojiclient.multicall = True
-            for add_build in add_builds:
-                self.kojiclient.tagBuild(tag_ids[added], add_build)
-            self.kojiclient.multiCall(strict=True)
-        for removed in remove_tags:
-            self.kojiclient.multicall = True
-            for build in builds:
-                self.kojiclient.untagBuild(removed, build, strict=False)
-            self.kojiclient.multiCall(strict=True)
+    def plan_package_lists(self, added, removed):
+        """Keep (tag, package) additions and removals changing package
+        lists, which are fetched once
+        Returns (added, removed)
+        """
+        added, removed = list(added), list(removed)
+        lists = self.retrieve_package_lists(
+            [tag for tag, _ in added + removed])
+        return ([(tag, pkg) for tag, pkg in added
+                 if pkg not in lists[tag]],
+                [(tag, pkg) for tag, pkg in removed if pkg in lists[tag]])
+
+    def _tagged_builds(self, pairs):
+        """untag Operation for every build of (tag, package) pairs, in a
+        single listTagged multicall
+        """
+        tag_ids = self._get_tag_ids([tag for tag, _ in pairs])
+        results = self._multicall(
+            [multicall.call('listTagged', tag_id, package=pkg)
+             for tag_id, (_, pkg) in zip(tag_ids, pairs)]).check().results
+        return [Operation('untag', tag, b['nvr'])
+                for (tag, _), builds in zip(pairs, results) for b in builds]
+
+    def update_package_lists(self, added, removed, username, force=False,
+                             journal=None):
+        """Register and unregister packages of several tags
+        added and removed are lists of (tag, package), additions are sent
+        first, all in batched multicalls. With force, builds of removed
+        packages are untagged before removal
+        Username is Koji owner
+        Completed calls are recorded in an optional journal.Journal as
+        ('add' or 'remove', tag, package), forced untags as Operation
+        Returns a MulticallReport
+        """
+        added, removed = list(added), list(removed)
+        tags = list(collections.OrderedDict.fromkeys(
+            tag for tag, _ in added + removed))
+        tag_ids = dict(zip(tags, self._get_tag_ids(tags)))
+        registered = self._multicall(
+            [multicall.call('packageListAdd', tag_ids[tag], pkg,
+                            owner=username)
+             for tag, pkg in added], write=True,
+            on_batch=journal_batches(journal, [('add', tag, pkg)
+                                               for tag, pkg in added])
+        ).check()
+        untagged = multicall.MulticallReport([], [])
+        if force and removed:
+            untagged = self.apply_plan(self._tagged_builds(removed), journal)
+        unregistered = self._multicall(
+            [multicall.call('packageListRemove', tag_ids[tag], pkg, force)
+             for tag, pkg in removed], write=True,
+            on_batch=journal_batches(journal, [('remove', tag, pkg)
+                                               for tag, pkg in removed])
+        ).check()
+        return multicall.merge([registered, untagged, unregistered])
+
+    def plan_tag_builds(self, target, tags, builds, tags_map,
+                        builds_info=None):
+        """Compute the minimal operations to bring builds to target
+        params:
+         - target: build expected status, see tag_builds
+         - tags: list of tags in a release
+         - builds: list of nvrs for the builds to be tagged
+         - tags_map: map of targets to indexes of required tags
+         - builds_info: optional retrieve_builds_info result covering
+           builds, fetched if not provided
+        Returns a list of Operation, taggings first
+        """
+        if builds_info is None:
+            builds_info = self.retrieve_builds_info(builds)
+        return plan_builds(target, tags, builds, tags_map, builds_info)
+
+    def apply_plan(self, plan, journal=None, jobs=1):
+        """Execute operations computed by plan_tag_builds
+        Builds are tagged before being untagged, untagging is skipped
+        if any tagging call failed.
+        With jobs > 1, the plan is split by build with split_plan and
+        parts run concurrently, each one on its own subsession
+        Completed operations are recorded in an optional journal.Journal
+        Returns a MulticallReport
+        """
+        tags = list(collections.OrderedDict.fromkeys(op.tag for op in plan))
+        tag_ids = dict(zip(tags, self._get_tag_ids(tags)))
+        parts = split_plan(plan, jobs)
+        if len(parts) > 1:
+            return self._apply_parts(parts, journal)
+        tag_ops = [op for op in plan if op.action == 'tag']
+        untag_ops = [op for op in plan if op.action == 'untag']
+        tagged = self._multicall(
+            [multicall.call('tagBuild', tag_ids[op.tag], op.build)
+             for op in tag_ops], write=True,
+            on_batch=journal_batches(journal, tag_ops)).check()
+        untagged = self._multicall(
+            [multicall.call('untagBuild', tag_ids[op.tag], op.build,
+                            strict=False)
+             for op in untag_ops], write=True,
+            on_batch=journal_batches(journal, untag_ops)).check()
+        return multicall.merge([tagged, untagged])
+
+    def _apply_parts(self, parts, journal=None):
+        """Apply independent plans concurrently on subsessions
+        Returns the merged MulticallReport, failures being raised once
+        all parts are done
+        """
+        self.login()
+        workers = []
+        for _ in parts:
+            worker = copy.copy(self)
+            worker.kojiclient = self._new_session(
+                self.kojiclient.subsession())
+            workers.append(worker)
+
+        def apply_part(index):
+            try:
+                return workers[index].apply_plan(parts[index], journal)
+            except multicall.MulticallError as exc:
+                return exc.report
+
+        try:
+            with futures.ThreadPoolExecutor(max_workers=len(parts)) as pool:
+                reports = list(pool.map(apply_part, range(len(parts))))
+        finally:
+            for worker in workers:
+                try:
+                    worker.kojiclient.logout()
+                except Exception:
+                    pass
+        return multicall.merge(reports).check()
 
     def tag_builds(self, target, tags, builds, tags_map):
         """Tag builds in koji
@@ -155,21 +460,82 @@ class KojiClient(object):
           * Packages tagged to -release will be also tagged into -testing.
 
         A specific target 'none' allows removing a build from all tags
+
+        Only missing tags are added and only tags builds are in are removed.
+        Returns a MulticallReport of the executed calls
         """
+        return self.apply_plan(
+            self.plan_tag_builds(target, tags, builds, tags_map))
 
-        available_targets = ['none', 'el7-build', 'el8-build', 'el9s-build',
-                             'el10s-build', 'candidate', 'testing', 'release']
-        if target not in available_targets:
-            raise Exception("""Target must be in {}.
-                            Provided '{}'""".format(available_targets, target))
 
-        if target == 'none':
-            for build in builds:
-                tag_ids = self._get_tag_ids(tags)
-                self.kojiclient.multicall = True
-                for tag_id in tag_ids:
-                    self.kojiclient.untagBuild(tag_id, build, strict=False)
-                self.kojiclient.multiCall(strict=True)
-        else:
-            add_tags = tags_map[target]
-            self._apply_tags(builds, tags, add_tags)
+def split_plan(plan, jobs):
+    """Split plan in at most jobs independent plans of similar sizes
+    All operations of a build stay in the same plan, in the same order,
+    so that it is tagged before being untagged
+    """
+    if jobs <= 1:
+        return [list(plan)]
+    builds = collections.OrderedDict()
+    for index, op in enumerate(plan):
+        builds.setdefault(op.build, []).append((index, op))
+    parts = [[] for _ in range(max(min(jobs, len(builds)), 1))]
+    for operations in sorted(builds.values(), key=len, reverse=True):
+        min(parts, key=len).extend(operations)
+    return [[op for _, op in sorted(part)] for part in parts if part] or [[]]
+
+
+def journal_batches(journal, operations):
+    """multicall on_batch callback recording in journal the operations
+    whose call succeeded, operations being in calls order
+    """
+    if journal is None:
+        return None
+
+    def on_batch(offset, entries):
+        journal.record([operations[offset + i]
+                        for i, entry in enumerate(entries)
+                        if not isinstance(entry, dict)])
+    return on_batch
+
+
+def plan_builds(target, tags, builds, tags_map, builds_info):
+    """Compute the minimal operations to bring builds to target, see
+    KojiClient.plan_tag_builds, builds_info covering builds
+    Returns a list of Operation, taggings first
+    """
+    if target not in TARGETS:
+        raise Exception("""Target must be in {}.
+                        Provided '{}'""".format(TARGETS, target))
+    missing = [build for build in builds if not builds_info.get(build)]
+    if missing:
+        raise Exception("Builds %s do not exist" % ', '.join(missing))
+
+    wanted = set()
+    if target != 'none':
+        wanted = set(tags[added] for added in tags_map[target])
+    added, removed = [], []
+    for build in builds:
+        current = set(builds_info[build]['tags'])
+        for tag in tags:
+            if tag in wanted and tag not in current:
+                added.append(Operation('tag', tag, build))
+            elif tag not in wanted and tag in current:
+                removed.append(Operation('untag', tag, build))
+    return added + removed
+
+
+def latest_builds(builds):
+    """keep latest build of each package from a listTagged result
+    Builds are consumed into a compact TagBuilds, only records of latest
+    builds are created
+    """
+    # Koji listTagged call returns latest modified build *not* latest build
+    # so we retrieve all builds and compaire build id to keep only latest
+    return TagBuilds.from_listing(builds).latest()
+
+
+def all_builds(builds):
+    """index builds from a listTagged result by build ID
+    Returns a compact snapshot.TagBuilds
+    """
+    return TagBuilds.from_listing(builds)
@@ -0,0 +1,112 @@
+"""graffiti.mirror keeps a local copy of koji tags contents
+"""
+import os
+import os.path
+import sqlite3
+import threading
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT PRIMARY KEY,
+    last_event INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_listing (
+    tag TEXT NOT NULL,
+    build_id INTEGER NOT NULL,
+    package_name TEXT NOT NULL,
+    nvr TEXT NOT NULL,
+    PRIMARY KEY (tag, build_id)
+);
+"""
+
+
+class TagMirror(object):
+    """SQLite store of tags memberships, with the last koji event applied
+    to each tag so that only newer tagging history has to be fetched
+    The connection may be used from several threads, one at a time
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def last_event(self, tag):
+        """Last koji event applied to tag, None if tag is not mirrored
+        """
+        with self.lock:
+            row = self.db.execute('SELECT last_event FROM tags '
+                                  'WHERE tag = ?', (tag,)).fetchone()
+        return row[0] if row else None
+
+    def builds(self, tag):
+        """Iterate over builds in tag, in listTagged format
+        """
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT build_id, package_name, nvr FROM tag_listing '
+                'WHERE tag = ? ORDER BY build_id DESC', (tag,)).fetchall()
+        for build_id, package_name, nvr in rows:
+            yield {'build_id': build_id, 'package_name': package_name,
+                   'nvr': nvr}
+
+    def replace(self, tag, builds, event):
+        """Replace tag contents with a full listTagged result
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM tag_listing WHERE tag = ?', (tag,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO tag_listing VALUES (?, ?, ?, ?)',
+                [(tag, b['build_id'], b['package_name'], b['nvr'])
+                 for b in builds])
+            self._set_event(tag, event)
+
+    def apply_history(self, tag, history, event):
+        """Apply tag_listing history entries newer than last event
+        """
+        with self.lock:
+            self._apply_history(tag, history, event)
+
+    def _apply_history(self, tag, history, event):
+        last = self.last_event(tag) or 0
+        changes = []
+        for entry in history:
+            nvr = '{}-{}-{}'.format(entry['name'], entry['version'],
+                                    entry['release'])
+            # within an event, untagging is applied before tagging
+            if entry['create_event'] > last:
+                changes.append((entry['create_event'], 1, entry, nvr))
+            if entry.get('revoke_event') and entry['revoke_event'] > last:
+                changes.append((entry['revoke_event'], 0, entry, nvr))
+        changes.sort(key=lambda change: change[:2])
+        with self.db:
+            for _, tagged, entry, nvr in changes:
+                if not tagged:
+                    self.db.execute('DELETE FROM tag_listing '
+                                    'WHERE tag = ? AND build_id = ?',
+                                    (tag, entry['build_id']))
+                else:
+                    self.db.execute('INSERT OR REPLACE INTO tag_listing '
+                                    'VALUES (?, ?, ?, ?)',
+                                    (tag, entry['build_id'], entry['name'],
+                                     nvr))
+            self._set_event(tag, event)
+
+    def _set_event(self, tag, event):
+        self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?)',
+                        (tag, event))
+
+    def reset(self):
+        """Forget all mirrored tags
+        """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM tag_listing')
+            self.db.execute('DELETE FROM tags')
@@ -0,0 +1,140 @@
+"""graffiti.multicall handles bounded and concurrent koji multicalls
+"""
+import collections
+from concurrent import futures
+
+
+Call = collections.namedtuple('Call', ['method', 'args', 'kwargs'])
+
+
+def call(method, *args, **kwargs):
+    """Describe a koji call to be executed in a multicall
+    """
+    return Call(method, args, kwargs)
+
+
+class MulticallError(Exception):
+    """Raised when some calls of a multicall failed
+    """
+    def __init__(self, report):
+        self.report = report
+        failed = report.failed
+        lines = ['{}{}: {}'.format(c.method, c.args, fault)
+                 for c, fault in failed]
+        super(MulticallError, self).__init__(
+            '{} of {} calls failed:\n  {}'.format(
+                len(failed), len(report), '\n  '.join(lines)))
+
+
+class MulticallReport(object):
+    """Per-call result or fault of a multicall execution
+    """
+    def __init__(self, calls, results):
+        # results entries are koji multicall entries: a singleton list
+        # for a successful call, a dict with faultString otherwise
+        self.calls = list(calls)
+        self.entries = list(results)
+
+    def __len__(self):
+        return len(self.calls)
+
+    @property
+    def results(self):
+        """Call results in calls order, None for failed calls
+        """
+        return [None if isinstance(entry, dict) else entry[0]
+                for entry in self.entries]
+
+    @property
+    def succeeded(self):
+        """Calls that succeeded
+        """
+        return [c for c, entry in zip(self.calls, self.entries)
+                if not isinstance(entry, dict)]
+
+    @property
+    def failed(self):
+        """List of (call, fault string) for calls that failed
+        """
+        return [(c, entry['faultString'])
+                for c, entry in zip(self.calls, self.entries)
+                if isinstance(entry, dict)]
+
+    def check(self):
+        """Raise MulticallError if any call failed
+        """
+        if self.failed:
+            raise MulticallError(self)
+        return self
+
+
+def merge(reports):
+    """Merge several reports in a single one
+    """
+    return MulticallReport(
+        [c for report in reports for c in report.calls],
+        [entry for report in reports for entry in report.entries])
+
+
+def _run_batch(session, calls):
+    """Run a batch of calls in a single multicall. If the request itself
+    fails, every call of the batch is reported as failed.
+    """
+    try:
+        session.multicall = True
+        for c in calls:
+            getattr(session, c.method)(*c.args, **c.kwargs)
+        return session.multiCall(strict=False)
+    except Exception as exc:
+        session.multicall = False
+        return [{'faultCode': -1, 'faultString': str(exc)}] * len(calls)
+
+
+def execute(session, calls, batch_size=500, jobs=1, new_session=None,
+            on_batch=None):
+    """Execute calls in multicalls of at most batch_size calls
+    With jobs > 1, batches are dispatched concurrently over sessions
+    created by new_session, koji subsessions of session by default.
+    on_batch(offset, entries) is called once a batch is done, offset
+    being the index of its first call
+    Returns a MulticallReport
+    """
+    calls = list(calls)
+    if not calls:
+        return MulticallReport([], [])
+    if not batch_size or batch_size <= 0:
+        batch_size = len(calls)
+    batches = [calls[i:i + batch_size]
+               for i in range(0, len(calls), batch_size)]
+
+    def run(batch_session, index):
+        entries = _run_batch(batch_session, batches[index])
+        if on_batch:
+            on_batch(index * batch_size, entries)
+        return entries
+
+    if jobs <= 1 or len(batches) <= 1:
+        results = [run(session, i) for i in range(len(batches))]
+    else:
+        workers = min(jobs, len(batches))
+        new_session = new_session or session.subsession
+        sessions = [new_session() for _ in range(workers)]
+
+        def worker(index):
+            return [(i, run(sessions[index], i))
+                    for i in range(index, len(batches), workers)]
+
+        results = [None] * len(batches)
+        try:
+            with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for done in pool.map(worker, range(workers)):
+                    for i, result in done:
+                        results[i] = result
+        finally:
+            for subsession in sessions:
+                try:
+                    subsession.logout()
+                except Exception:
+                    pass
+    entries = [entry for result in results for entry in result]
+    return MulticallReport(calls, entries)
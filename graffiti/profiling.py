@@ -0,0 +1,144 @@
+"""graffiti.profiling records koji RPC statistics
+"""
+from __future__ import print_function
+import importlib
+import json
+import sys
+import threading
+import time
+
+
+class RPCStats(object):
+    """Thread-safe collector of koji RPC statistics
+    Hooks are called with a dict describing every RPC, for metrics sinks
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.multicall_sizes = []
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """Register a callable receiving each RPC record
+        """
+        self.hooks.append(hook)
+
+    def record(self, method, elapsed, bytes_out, bytes_in, calls=None):
+        """Record a RPC, calls lists methods batched in a multicall
+        """
+        with self.lock:
+            stats = self.methods.setdefault(method, {
+                'count': 0, 'time': 0.0, 'max_time': 0.0,
+                'bytes_out': 0, 'bytes_in': 0})
+            stats['count'] += 1
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['bytes_out'] += bytes_out
+            stats['bytes_in'] += bytes_in
+            if calls is not None:
+                self.multicall_sizes.append(len(calls))
+        event = {'method': method, 'time': elapsed, 'bytes_out': bytes_out,
+                 'bytes_in': bytes_in}
+        if calls is not None:
+            event['calls'] = calls
+        for hook in self.hooks:
+            hook(event)
+
+    def summary(self):
+        """Statistics as a JSON serializable dict
+        """
+        with self.lock:
+            sizes = list(self.multicall_sizes)
+            methods = dict((name, dict(stats))
+                           for name, stats in self.methods.items())
+        return {'requests': sum(s['count'] for s in methods.values()),
+                'time': sum(s['time'] for s in methods.values()),
+                'bytes_out': sum(s['bytes_out'] for s in methods.values()),
+                'bytes_in': sum(s['bytes_in'] for s in methods.values()),
+                'methods': methods,
+                'multicalls': {'count': len(sizes),
+                               'calls': sum(sizes),
+                               'max_size': max(sizes) if sizes else 0}}
+
+    def report(self, command=None, out=None):
+        """Print a human readable summary
+        """
+        out = out or sys.stderr
+        summary = self.summary()
+        print('koji RPC profile{}: {} requests, {:.3f}s, {} bytes sent, '
+              '{} bytes received'.format(
+                  ' for {}'.format(command) if command else '',
+                  summary['requests'], summary['time'],
+                  summary['bytes_out'], summary['bytes_in']), file=out)
+        methods = sorted(summary['methods'].items(),
+                         key=lambda item: item[1]['time'], reverse=True)
+        for name, stats in methods:
+            print('  {:<20} {:>6} calls {:>9.3f}s (max {:.3f}s) '
+                  '{:>10} B sent {:>10} B received'.format(
+                      name, stats['count'], stats['time'],
+                      stats['max_time'], stats['bytes_out'],
+                      stats['bytes_in']), file=out)
+        multicalls = summary['multicalls']
+        if multicalls['count']:
+            print('  {} multicalls batching {} calls, largest {}'.format(
+                multicalls['count'], multicalls['calls'],
+                multicalls['max_size']), file=out)
+
+    def dump(self, filename, command=None):
+        """Write summary as JSON
+        """
+        summary = self.summary()
+        summary['command'] = command
+        with open(filename, 'w') as out:
+            json.dump(summary, out, indent=2)
+
+
+def load_hook(path):
+    """Load a hook from a 'module:callable' string
+    """
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def instrument(session, stats):
+    """Record every RPC sent by a koji ClientSession in stats
+    """
+    call_method = session._callMethod
+    send_call = session._sendCall
+    read_response = session._read_xmlrpc_response
+    sizes = {}
+
+    def _callMethod(name, args, kwargs=None, retry=True):
+        if session.multicall:
+            # legacy multicall, call is only queued
+            return call_method(name, args, kwargs, retry)
+        sizes['out'] = sizes['in'] = 0
+        start = time.time()
+        try:
+            return call_method(name, args, kwargs, retry)
+        finally:
+            calls = None
+            if name == 'multiCall':
+                calls = [c['methodName'] for c in args[0]]
+            stats.record(name, time.time() - start, sizes['out'],
+                         sizes['in'], calls)
+
+    def _sendCall(handler, headers, request):
+        sizes['out'] += len(request)
+        return send_call(handler, headers, request)
+
+    def _read_xmlrpc_response(response):
+        iter_content = response.iter_content
+
+        def counted(*args, **kwargs):
+            for chunk in iter_content(*args, **kwargs):
+                sizes['in'] += len(chunk)
+                yield chunk
+
+        response.iter_content = counted
+        return read_response(response)
+
+    session._callMethod = _callMethod
+    session._sendCall = _sendCall
+    session._read_xmlrpc_response = _read_xmlrpc_response
+    return session
@@ -0,0 +1,173 @@
+"""graffiti.report handles release tags comparisons and tag plans
+
+These are shared by the command line and the graffiti service, koji may be
+a KojiClient or a snapshot.TagSnapshot answering the same read queries.
+"""
+import collections
+import six
+
+
+def _tags_offset(config, release):
+    """Index of the candidate tag in a release buildsys-tags, releases
+    using separated_buildreqs have a build tag first
+    """
+    release_info = config['releases_info'][release]
+    if 'tags_map' in release_info.keys():
+        map_name = release_info['tags_map']
+    else:
+        map_name = 'unified_buildreqs'
+    return 0 if map_name == 'unified_buildreqs' else 1
+
+
+def candidate_tags(config, release):
+    """Return (candidate tag, testing tag) of a release
+    """
+    tags = config['releases'][release]
+    offset = _tags_offset(config, release)
+    return tags[offset], tags[offset + 1]
+
+
+def testing_tags(config, release):
+    """Return (testing tag, release tag) of a release
+    """
+    tags = config['releases'][release]
+    offset = _tags_offset(config, release)
+    return tags[offset + 1], tags[offset + 2]
+
+
+def compared_tags(config, release):
+    """Tags compared by list commands for a release
+    """
+    offset = _tags_offset(config, release)
+    return config['releases'][release][offset:offset + 3]
+
+
+def iter_candidates(koji, tag_from, tag_to, packages=None, hub_latest=False):
+    """Yields (package, build) for builds in 'tag_from' but not in 'tag_to'
+    packages restricts the comparison to some packages
+    With hub_latest, tags are fetched with hub-side latest tagged builds,
+    then packages whose latest builds differ are checked against their
+    full listing. Packages with the same latest tagged build in both tags
+    are assumed up to date.
+    """
+    candidates = koji.retrieve_builds(tag_from, packages, latest=hub_latest)
+    testing = koji.retrieve_builds(tag_to, packages, latest=hub_latest)
+    if hub_latest:
+        from graffiti.snapshot import latest_from_all
+        changed = [k for k in candidates
+                   if k not in testing or
+                   candidates[k]['id'] != testing[k]['id']]
+        if changed:
+            tags = koji.retrieve_tags_builds([tag_from, tag_to], changed)
+            candidates.update(latest_from_all(tags[tag_from]))
+            testing.update(latest_from_all(tags[tag_to]))
+    for item in diff_candidates(candidates, testing):
+        yield item
+
+
+def diff_candidates(candidates, testing):
+    """Yields (package, build) for latest builds in 'candidates' newer
+    than latest build of the same package in 'testing'
+    """
+    for k in six.iterkeys(candidates):
+        if k in testing:
+            if candidates[k]['id'] > testing[k]['id']:
+                yield k, candidates[k]
+        else:
+            yield k, candidates[k]
+
+
+def iter_old_candidates(koji, tag_from, tag_to, packages=None):
+    """Yields (build ID, build) for builds in 'tag_from' but not in
+       'tag_to' which are older that latest on in 'tag_to'
+       packages restricts the comparison to some packages
+    """
+    candidates = koji.retrieve_all_builds(tag_from, packages)
+    testing = koji.retrieve_all_builds(tag_to, packages)
+    for item in diff_old_candidates(candidates, testing):
+        yield item
+
+
+def diff_old_candidates(candidates, testing):
+    """Yields (build ID, build) for builds in 'candidates' but not in
+       'testing' which are older that latest on in 'testing'
+       Packages without builds in 'testing' are skipped
+    """
+    from graffiti.snapshot import TagBuilds
+    return TagBuilds.from_builds(candidates).older_than_latest(testing)
+
+
+def compute_promotion_report(koji, config, release):
+    """Computes all promotion diffs of a release, fetching each tag once
+    Returns a list of dicts with report name, tag pair and builds
+    """
+    from graffiti.snapshot import latest_from_all
+    tag_from, tag_to = candidate_tags(config, release)
+    pairs = [('candidates', tag_from, tag_to),
+             ('old-candidates', tag_from, tag_to)]
+    offset = _tags_offset(config, release)
+    if len(config['releases'][release]) > offset + 2:
+        tag_from, tag_to = testing_tags(config, release)
+        pairs.append(('testing', tag_from, tag_to))
+    tags = koji.retrieve_tags_builds(
+        [tag for _, tag_from, tag_to in pairs for tag in (tag_from, tag_to)])
+    latest = dict((tag, latest_from_all(builds))
+                  for tag, builds in six.iteritems(tags))
+    report = []
+    for name, tag_from, tag_to in pairs:
+        if name == 'old-candidates':
+            builds = diff_old_candidates(tags[tag_from], tags[tag_to])
+        else:
+            builds = diff_candidates(latest[tag_from], latest[tag_to])
+        report.append({'report': name, 'tag_from': tag_from,
+                       'tag_to': tag_to, 'builds': dict(builds)})
+    return report
+
+
+def release_tags_map(config, release):
+    """Return (tags, tags_map) of a release
+    """
+    release_info = config['releases_info'][release]
+    tags = config['releases'][release]
+    if 'tags_map' in release_info.keys():
+        map_name = release_info['tags_map']
+        tags_map = config['tags_maps'][map_name]
+    else:
+        tags_map = config['tags_maps']['unified_buildreqs']
+    return tags, tags_map
+
+
+def plan_tag_commands(koji, config, cmds, tags_index=False):
+    """Compute the minimal tag operations of a command file
+    Current state of every build is fetched in bulk with multicalls
+    With tags_index, builds are looked up in the listings of the release
+    tags, only builds in none of them are queried one by one
+    koji may be a TagSnapshot, builds are then looked up in its tags only
+    """
+    from graffiti.kojiclient import plan_builds
+    builds = [build for dat in six.itervalues(cmds)
+              for target_builds in six.itervalues(dat)
+              for build in target_builds]
+    tags = None
+    if tags_index:
+        tags = [tag for release in cmds
+                for tag in release_tags_map(config, release)[0]]
+    builds_info = koji.retrieve_builds_info(builds, tags)
+    missing = [build for build in builds if not builds_info[build]]
+    if missing:
+        raise Exception("Builds %s do not exist" % ', '.join(missing))
+    plan = []
+    for release, dat in six.iteritems(cmds):
+        tags, tags_map = release_tags_map(config, release)
+        for target, target_builds in six.iteritems(dat):
+            plan.extend(plan_builds(target, tags, target_builds, tags_map,
+                                    builds_info))
+    # releases may share tags
+    plan = list(collections.OrderedDict.fromkeys(plan))
+    tagged = set((op.tag, op.build) for op in plan if op.action == 'tag')
+    conflicts = ['{} {}'.format(op.tag, op.build) for op in plan
+                 if op.action == 'untag' and (op.tag, op.build) in tagged]
+    if conflicts:
+        raise Exception("Builds both tagged and untagged: %s" %
+                        ', '.join(conflicts))
+    return plan
@@ -0,0 +1,352 @@
+"""graffiti.server handles the long-running graffiti service
+
+Parsed configuration, tag IDs and tags contents are kept in memory.
+Configuration is only parsed again when its fingerprint changes and only
+tags whose history moved since the last koji event are fetched again.
+Queries are answered from the in-memory snapshot over a local HTTP/JSON
+API.
+"""
+import collections
+import itertools
+import json
+import threading
+import time
+from six.moves import queue
+from six.moves.urllib.parse import parse_qs, urlparse
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from graffiti import report
+from graffiti.snapshot import TagSnapshot
+
+
+class ServiceError(Exception):
+    """Query error reported to HTTP clients with status code
+    """
+    def __init__(self, status, message):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+
+class GraffitiService(object):
+    """Serve graffiti queries from an in-memory snapshot of release tags
+    load_config returns the parsed configuration, configure_koji returns
+    a KojiClient for it. releases restricts served releases, all by
+    default. Tag jobs are only accepted with allow_tag.
+    config_key(config) identifies the configuration state from the last
+    loaded one, configuration is reloaded on every refresh without it.
+    """
+    def __init__(self, load_config, configure_koji, releases=None,
+                 interval=300, allow_tag=False, config_key=None):
+        self.load_config = load_config
+        self.config_key = config_key
+        self.configure_koji = configure_koji
+        self.releases = releases
+        self.interval = interval
+        self.allow_tag = allow_tag
+        self.lock = threading.Lock()
+        self.config = None
+        self._config_key = None
+        self.koji = None
+        self.served = []
+        self.snapshot = None
+        self.last_error = None
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._job_queue = queue.Queue()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def refresh(self):
+        """Reload configuration and tags contents if they changed
+        Returns True if a new snapshot was taken
+        """
+        config = self._load_config()
+        # a new client may query another hub, no tag is kept then
+        new_client = self.koji is None or \
+            self._client_config(config) != self._client_config(self.config)
+        if new_client:
+            self.koji = self.configure_koji(config)
+        event = self.koji.last_event()
+        if self.snapshot and self.snapshot.event == event and \
+                self.config == config:
+            return False
+        releases = self.releases or sorted(config['releases'])
+        unknown = [r for r in releases if r not in config['releases']]
+        if unknown:
+            raise Exception("Unknown releases %s" % ', '.join(unknown))
+        tags = list(collections.OrderedDict.fromkeys(
+            tag for release in releases
+            for tag in report.compared_tags(config, release)))
+        tags_builds = {} if new_client else self._unchanged_tags(tags, event)
+        fetched = [tag for tag in tags if tag not in tags_builds]
+        if fetched:
+            self.koji.expire_mirror()
+            tags_builds.update(self.koji.retrieve_tags_builds(fetched))
+        snapshot = TagSnapshot(tags_builds, event, time.time())
+        with self.lock:
+            self.config, self.served, self.snapshot = \
+                config, releases, snapshot
+        return True
+
+    def _load_config(self):
+        """Current configuration, only parsed again when config_key
+        changed
+        """
+        if self.config_key is None:
+            return self.load_config()
+        key = self.config_key(self.config)
+        if self.config is None or key != self._config_key:
+            config = self.load_config()
+            self._config_key = self.config_key(config)
+            return config
+        return self.config
+
+    @staticmethod
+    def _client_config(config):
+        """Configuration sections the koji client is built from
+        """
+        config = config or {}
+        return config.get('koji'), config.get('cache')
+
+    def _unchanged_tags(self, tags, event):
+        """Builds of snapshot tags whose history did not move since the
+        snapshot event, as a dict indexed by tag
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {}
+        known = [tag for tag in tags if tag in snapshot.tags]
+        changed = set()
+        if known and snapshot.event != event:
+            changed = set(self.koji.changed_tags(known, snapshot.event))
+        return dict((tag, snapshot.tags[tag]) for tag in known
+                    if tag not in changed)
+
+    def _refresh_loop(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as exc:
+                self.last_error = str(exc)
+
+    def _state(self, release):
+        with self.lock:
+            config, snapshot = self.config, self.snapshot
+        if snapshot is None:
+            raise ServiceError(503, "Tags are not loaded yet")
+        if release not in self.served:
+            raise ServiceError(404, "Unknown release %s" % release)
+        return config, snapshot
+
+    def status(self):
+        """Service state as a JSON serializable dict
+        """
+        snapshot = self.snapshot
+        return {'releases': self.served,
+                'event': snapshot.event if snapshot else None,
+                'timestamp': snapshot.timestamp if snapshot else None,
+                'last_error': self.last_error,
+                'jobs': len(self.jobs)}
+
+    def list_candidates(self, release, old=False, packages=None):
+        """Same result as list-candidates command
+        """
+        config, snapshot = self._state(release)
+        tag_from, tag_to = report.candidate_tags(config, release)
+        if old:
+            builds = report.iter_old_candidates(snapshot, tag_from, tag_to,
+                                                packages)
+        else:
+            builds = report.iter_candidates(snapshot, tag_from, tag_to,
+                                            packages)
+        return self._result(snapshot, release, tag_from, tag_to, builds)
+
+    def list_testing(self, release, packages=None):
+        """Same result as list-testing command
+        """
+        config, snapshot = self._state(release)
+        if len(report.compared_tags(config, release)) < 3:
+            raise ServiceError(404, "Release %s has no release tag" %
+                               release)
+        tag_from, tag_to = report.testing_tags(config, release)
+        builds = report.iter_candidates(snapshot, tag_from, tag_to, packages)
+        return self._result(snapshot, release, tag_from, tag_to, builds)
+
+    def promotion_report(self, release):
+        """Same result as promotion-report command
+        """
+        config, snapshot = self._state(release)
+        return {'release': release, 'event': snapshot.event,
+                'reports': report.compute_promotion_report(snapshot, config,
+                                                           release)}
+
+    def _result(self, snapshot, release, tag_from, tag_to, builds):
+        return {'release': release, 'event': snapshot.event,
+                'tag_from': tag_from, 'tag_to': tag_to,
+                'builds': dict(builds)}
+
+    def submit_tag(self, cmds):
+        """Queue a tag job, cmds has the command file format
+        Returns the job ID
+        """
+        if not self.allow_tag:
+            raise ServiceError(403, "Tag jobs are disabled")
+        if not isinstance(cmds, dict):
+            raise ServiceError(400, "Invalid tag command")
+        job_id = next(self._job_ids)
+        self.jobs[job_id] = {'id': job_id, 'status': 'queued',
+                             'operations': None, 'error': None}
+        self._job_queue.put((job_id, cmds))
+        return job_id
+
+    def job(self, job_id):
+        """Tag job status
+        """
+        try:
+            return dict(self.jobs[job_id])
+        except KeyError:
+            raise ServiceError(404, "Unknown job %s" % job_id)
+
+    def run_job(self, job_id, cmds):
+        """Plan and apply a tag job with its own koji session
+        """
+        job = self.jobs[job_id]
+        job['status'] = 'running'
+        try:
+            with self.lock:
+                config = self.config
+            koji = self.configure_koji(config)
+            plan = report.plan_tag_commands(koji, config, cmds)
+            koji.apply_plan(plan)
+            job['operations'] = ['{} {} {}'.format(*op) for op in plan]
+            job['status'] = 'done'
+        except Exception as exc:
+            job['error'] = str(exc)
+            job['status'] = 'failed'
+        # tags changed, refresh now
+        self._wakeup.set()
+
+    def _job_loop(self):
+        while not self._stopped.is_set():
+            try:
+                job_id, cmds = self._job_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.run_job(job_id, cmds)
+
+    def start(self):
+        """Load tags, then refresh them and run jobs in background
+        """
+        self.refresh()
+        targets = [self._refresh_loop]
+        if self.allow_tag:
+            targets.append(self._job_loop)
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API over a GraffitiService
+    GET /status, /releases, /list-candidates/<release>,
+    /list-testing/<release>, /promotion-report/<release>, /jobs/<id>
+    POST /tag
+    """
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        service = self.server.service
+        url = urlparse(self.path)
+        path = [part for part in url.path.split('/') if part]
+        params = parse_qs(url.query)
+        packages = None
+        if 'packages' in params:
+            packages = [pkg for value in params['packages']
+                        for pkg in value.split(',') if pkg]
+        old = params.get('old', ['0'])[0] not in ('0', 'false', '')
+        try:
+            if method == 'POST' and path == ['tag']:
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    cmds = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    raise ServiceError(400, "Invalid JSON body")
+                return self._reply(202, {'job': service.submit_tag(cmds)})
+            if method != 'GET':
+                raise ServiceError(405, "Method not allowed")
+            if path == ['status']:
+                return self._reply(200, service.status())
+            if path == ['releases']:
+                return self._reply(200, service.served)
+            if len(path) == 2 and path[0] == 'list-candidates':
+                return self._reply(200, service.list_candidates(
+                    path[1], old, packages))
+            if len(path) == 2 and path[0] == 'list-testing':
+                return self._reply(200, service.list_testing(path[1],
+                                                             packages))
+            if len(path) == 2 and path[0] == 'promotion-report':
+                return self._reply(200, service.promotion_report(path[1]))
+            if len(path) == 2 and path[0] == 'jobs' and path[1].isdigit():
+                return self._reply(200, service.job(int(path[1])))
+            raise ServiceError(404, "Unknown path %s" % url.path)
+        except ServiceError as exc:
+            self._reply(exc.status, {'error': str(exc)})
+        except Exception as exc:
+            self._reply(500, {'error': str(exc)})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, verbose=False):
+        HTTPServer.__init__(self, address, RequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+
+def serve(service, host='127.0.0.1', port=8080, verbose=True):
+    """Start service and answer HTTP queries until interrupted
+    """
+    service.start()
+    server = Server((host, port), service, verbose)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.stop()
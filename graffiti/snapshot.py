@@ -0,0 +1,299 @@
+"""graffiti.snapshot handles in-memory copies of koji tags contents
+
+Snapshots can be dumped to a gzip file and loaded back to run analyses
+offline, build IDs and package names being stored as raw arrays.
+"""
+import array
+import collections
+import gzip
+import json
+import struct
+import sys
+import six
+from six.moves import intern
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class TagBuilds(Mapping):
+    """Compact read-only builds of a tag, indexed by build ID
+    Builds are stored in parallel arrays with interned package names,
+    records are only created when a build is accessed
+    """
+    __slots__ = ('_ids', '_names', '_nvrs', '_index', '_latest')
+
+    def __init__(self, ids=(), names=(), nvrs=()):
+        self._ids = array.array('q', ids)
+        self._names = list(names)
+        self._nvrs = list(nvrs)
+        self._index = None
+        self._latest = None
+
+    @classmethod
+    def from_listing(cls, builds):
+        """Consume a listTagged result or a TagMirror.builds iterator
+        """
+        tag_builds = cls()
+        for b in builds:
+            tag_builds._append(b['build_id'], b['package_name'], b['nvr'])
+        return tag_builds
+
+    @classmethod
+    def from_builds(cls, builds):
+        """Compact a mapping of build ID to build records
+        """
+        if isinstance(builds, cls):
+            return builds
+        tag_builds = cls()
+        for b in six.itervalues(builds):
+            tag_builds._append(b['id'], b['name'], b['nvr'])
+        return tag_builds
+
+    def _append(self, build_id, name, nvr):
+        self._ids.append(build_id)
+        self._names.append(intern(str(name)))
+        self._nvrs.append(nvr)
+
+    def _indexed(self):
+        if self._index is None:
+            self._index = dict((b, i) for i, b in enumerate(self._ids))
+        return self._index
+
+    def _position(self, build_id):
+        return self._indexed()[build_id]
+
+    def _record(self, i):
+        return {'name': self._names[i], 'id': self._ids[i],
+                'nvr': self._nvrs[i]}
+
+    def __getitem__(self, build_id):
+        return self._record(self._position(build_id))
+
+    def __contains__(self, build_id):
+        try:
+            self._position(build_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __repr__(self):
+        return 'TagBuilds(%d builds)' % len(self)
+
+    def iteritems(self):
+        for i in range(len(self._ids)):
+            yield self._ids[i], self._record(i)
+
+    def itervalues(self):
+        for i in range(len(self._ids)):
+            yield self._record(i)
+
+    # records are created while iterating
+    items = iteritems
+    values = itervalues
+
+    def ids(self):
+        """Build IDs as a set
+        """
+        return six.viewkeys(self._indexed())
+
+    def latest_ids(self):
+        """Map package names to their latest build ID
+        """
+        if self._latest is None:
+            latest = {}
+            for build_id, name in zip(self._ids, self._names):
+                if latest.get(name, -1) < build_id:
+                    latest[name] = build_id
+            self._latest = latest
+        return self._latest
+
+    def latest(self):
+        """Latest build of each package, indexed by package name
+        """
+        return dict((name, self[build_id])
+                    for name, build_id in six.iteritems(self.latest_ids()))
+
+    def filter(self, packages):
+        """Builds of some packages only
+        """
+        packages = set(packages)
+        kept = [i for i, name in enumerate(self._names) if name in packages]
+        return TagBuilds([self._ids[i] for i in kept],
+                         [self._names[i] for i in kept],
+                         [self._nvrs[i] for i in kept])
+
+    def select_nvrs(self, nvrs):
+        """Yields builds whose NVR is in nvrs
+        """
+        nvrs = set(nvrs)
+        for i, nvr in enumerate(self._nvrs):
+            if nvr in nvrs:
+                yield self._record(i)
+
+    def older_than_latest(self, other):
+        """Yields (build ID, build) for builds not in other which are
+        older than the latest build of the same package in other
+        """
+        other = TagBuilds.from_builds(other)
+        ids = other.ids()
+        latest = other.latest_ids()
+        for i, (build_id, name) in enumerate(zip(self._ids, self._names)):
+            if build_id not in ids and build_id < latest.get(name, -1):
+                yield build_id, self._record(i)
+
+
+def latest_from_all(builds):
+    """keep latest build of each package from a retrieve_all_builds result
+    """
+    if isinstance(builds, TagBuilds):
+        return builds.latest()
+    latest = {}
+    for b in six.itervalues(builds):
+        name = b['name']
+        if name not in latest or latest[name]['id'] < b['id']:
+            latest[name] = b
+    return latest
+
+
+def index_builds(builds, tags_builds):
+    """Look builds up in retrieve_tags_builds results
+    Returns (builds_info, missing): retrieve_builds_info entries of builds
+    found in some tags, their 'tags' only listing these tags, and builds
+    found in none of them
+    """
+    builds_info = {}
+    for tag, tag_builds in six.iteritems(tags_builds):
+        for build in TagBuilds.from_builds(tag_builds).select_nvrs(builds):
+            builds_info.setdefault(build['nvr'], dict(build, tags=[]))
+            builds_info[build['nvr']]['tags'].append(tag)
+    missing = [build for build in collections.OrderedDict.fromkeys(builds)
+               if build not in builds_info]
+    return builds_info, missing
+
+
+SNAPSHOT_MAGIC = b'graffiti-snapshot 1\n'
+
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise Exception("Snapshot %s is truncated" % stream.name)
+    return data
+
+
+def _read_array(stream, typecode, count, swap):
+    values = array.array(typecode)
+    data = _read(stream, values.itemsize * count)
+    if six.PY3:
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if swap:
+        values.byteswap()
+    return values
+
+
+class TagSnapshot(object):
+    """Read-only tags contents answering the same read queries as
+    KojiClient, so that list commands can run against it
+    tags maps tag names to retrieve_all_builds results
+    """
+    def __init__(self, tags, event=None, timestamp=None):
+        self.tags = dict((tag, TagBuilds.from_builds(builds))
+                         for tag, builds in six.iteritems(tags))
+        self.event = event
+        self.timestamp = timestamp
+
+    def dump(self, path):
+        """Write the snapshot to a gzip file
+        Each tag is stored as its build IDs array, an array of indexes in
+        its package names and its NVRs
+        """
+        header = {'event': self.event, 'timestamp': self.timestamp,
+                  'byteorder': sys.byteorder, 'tags': []}
+        parts = []
+        for tag, builds in sorted(six.iteritems(self.tags)):
+            names = list(collections.OrderedDict.fromkeys(builds._names))
+            positions = dict((name, i) for i, name in enumerate(names))
+            indexes = array.array('i', [positions[name]
+                                        for name in builds._names])
+            nvrs = '\n'.join(builds._nvrs).encode('utf-8')
+            header['tags'].append([tag, len(builds), names])
+            parts.append((builds._ids, indexes, nvrs))
+        with gzip.open(path, 'wb') as stream:
+            stream.write(SNAPSHOT_MAGIC)
+            stream.write(json.dumps(header).encode('utf-8') + b'\n')
+            for ids, indexes, nvrs in parts:
+                for values in (ids, indexes):
+                    if six.PY3:
+                        stream.write(values.tobytes())
+                    else:
+                        stream.write(values.tostring())
+                stream.write(struct.pack('<Q', len(nvrs)))
+                stream.write(nvrs)
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot written by dump
+        """
+        with gzip.open(path, 'rb') as stream:
+            if stream.readline() != SNAPSHOT_MAGIC:
+                raise Exception("%s is not a graffiti snapshot" % path)
+            header = json.loads(stream.readline().decode('utf-8'))
+            swap = header['byteorder'] != sys.byteorder
+            tags = {}
+            for tag, count, names in header['tags']:
+                names = [intern(str(name)) for name in names]
+                builds = TagBuilds()
+                builds._ids = _read_array(stream, 'q', count, swap)
+                builds._names = [names[i] for i in
+                                 _read_array(stream, 'i', count, swap)]
+                size, = struct.unpack('<Q', _read(stream, 8))
+                nvrs = _read(stream, size).decode('utf-8')
+                builds._nvrs = nvrs.split('\n') if count else []
+                tags[tag] = builds
+        return cls(tags, header['event'], header['timestamp'])
+
+    def _builds(self, tag, packages=None):
+        try:
+            builds = self.tags[tag]
+        except KeyError:
+            raise Exception("Tag %s is not in snapshot" % tag)
+        if packages is None:
+            return builds
+        return builds.filter(packages)
+
+    def retrieve_all_builds(self, tag, packages=None):
+        """retrieve all builds in a tag
+        """
+        return self._builds(tag, packages)
+
+    def retrieve_builds(self, tag, packages=None, latest=False):
+        """retrieve latest builds in a tag
+        """
+        return self._builds(tag, packages).latest()
+
+    def retrieve_tags_builds(self, tags, packages=None):
+        """retrieve all builds of several tags
+        """
+        return dict((tag, self._builds(tag, packages)) for tag in tags)
+
+    def retrieve_builds_info(self, builds, tags=None):
+        """retrieve info about builds from the snapshot tags
+        Returns a dict indexed by build, builds in no tag map to None
+        """
+        if tags is None:
+            tags = self.tags
+        builds_info, missing = index_builds(builds,
+                                            self.retrieve_tags_builds(tags))
+        builds_info.update((build, None) for build in missing)
+        return builds_info
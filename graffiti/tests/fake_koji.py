@@ -0,0 +1,152 @@
+# Fake koji session for tests
+#
+
+
+class FakeKojiSession(object):
+    """Minimal in-memory koji hub supporting legacy multicall
+    """
+    rsession = None
+
+    def __init__(self, tags=None, builds=None, tagged=None):
+        # tags: {name: id}, builds: {nvr: build_id}, tagged: {tag: [nvr]}
+        self.tags = dict(tags or {})
+        self.builds = dict(builds or {})
+        self.tagged = dict((t, list(n)) for t, n in (tagged or {}).items())
+        self.calls = []
+        self.multicalled = []
+        self.multicall = False
+        self._queue = []
+        self.event = 1
+        self.history = []
+        self.packages = {}
+        for tag, nvrs in self.tagged.items():
+            for nvr in nvrs:
+                self._add_history(tag, nvr)
+
+    def _record(self, name, *args, **kwargs):
+        if self.multicall:
+            self._queue.append((name, args, kwargs))
+            return None
+        self.calls.append(name)
+        return getattr(self, '_' + name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._record(name, *args, **kwargs)
+
+    def subsession(self):
+        sub = FakeKojiSession()
+        sub.tags, sub.builds, sub.tagged = self.tags, self.builds, self.tagged
+        sub.calls, sub.multicalled = self.calls, self.multicalled
+        sub.packages = self.packages
+        return sub
+
+    def multiCall(self, strict=False, batch=None):
+        self.multicall = False
+        self.calls.append('multiCall')
+        queue, self._queue = self._queue, []
+        results = []
+        for name, args, kwargs in queue:
+            self.multicalled.append(name)
+            try:
+                results.append([getattr(self, '_' + name)(*args, **kwargs)])
+            except Exception as exc:
+                if strict:
+                    raise
+                results.append({'faultCode': 1000, 'faultString': str(exc)})
+        return results
+
+    def _tag_name(self, tag):
+        if tag in self.tags:
+            return tag
+        for name, tag_id in self.tags.items():
+            if tag_id == tag:
+                return name
+        return None
+
+    def _build_info(self, nvr):
+        name = nvr.rsplit('-', 2)[0]
+        return {'build_id': self.builds[nvr], 'id': self.builds[nvr],
+                'nvr': nvr, 'package_name': name, 'name': name}
+
+    def _add_history(self, tag, nvr):
+        name, version, release = nvr.rsplit('-', 2)
+        self.history.append({'tag': tag, 'build_id': self.builds[nvr],
+                             'name': name, 'version': version,
+                             'release': release, 'active': True,
+                             'create_event': self.event,
+                             'revoke_event': None})
+
+    def _ssl_login(self, *args, **kwargs):
+        return True
+
+    def _logout(self):
+        pass
+
+    def _listTags(self, build=None):
+        if build is None:
+            return [{'name': n, 'id': i} for n, i in self.tags.items()]
+        if build not in self.builds:
+            raise Exception('No such build: %s' % build)
+        return [{'name': t, 'id': self.tags[t]}
+                for t, nvrs in self.tagged.items() if build in nvrs]
+
+    def _getTag(self, tag):
+        name = self._tag_name(tag)
+        if name is None:
+            return None
+        return {'name': name, 'id': self.tags[name]}
+
+    def _getBuild(self, build):
+        if build not in self.builds:
+            return None
+        return self._build_info(build)
+
+    def _listTagged(self, tag, latest=False, package=None):
+        name = self._tag_name(tag)
+        builds = [self._build_info(nvr) for nvr in self.tagged.get(name, [])
+                  if package is None or nvr.rsplit('-', 2)[0] == package]
+        if latest:
+            # latest tagged build of each package
+            seen = set()
+            builds = [b for b in reversed(builds) if b['name'] not in seen
+                      and not seen.add(b['name'])]
+        return builds
+
+    def _getLastEvent(self):
+        return {'id': self.event, 'ts': 0}
+
+    def _queryHistory(self, tables=None, tag=None, afterEvent=None):
+        name = self._tag_name(tag)
+        after = afterEvent or 0
+        return {'tag_listing': [
+            dict(e) for e in self.history if e['tag'] == name and
+            (e['create_event'] > after or (e['revoke_event'] or 0) > after)]}
+
+    def _tagBuild(self, tag, build):
+        self.event += 1
+        self.tagged.setdefault(self._tag_name(tag), []).append(build)
+        self._add_history(self._tag_name(tag), build)
+
+    def _untagBuild(self, tag, build, strict=True):
+        nvrs = self.tagged.get(self._tag_name(tag), [])
+        if build in nvrs:
+            self.event += 1
+            nvrs.remove(build)
+            for entry in self.history:
+                if entry['tag'] == self._tag_name(tag) and \
+                        entry['build_id'] == self.builds[build] and \
+                        entry['active']:
+                    entry['active'] = False
+                    entry['revoke_event'] = self.event
+
+    def _packageListAdd(self, tag, pkg, owner=None):
+        self.packages.setdefault(self._tag_name(tag), set()).add(pkg)
+
+    def _packageListRemove(self, tag, pkg, force=False):
+        self.packages.setdefault(self._tag_name(tag), set()).discard(pkg)
+
+    def _listPackages(self, tagID=None, inherited=True):
+        return [{'package_name': pkg} for pkg in
+                sorted(self.packages.get(self._tag_name(tagID), []))]
@@ -0,0 +1,109 @@
+import threading
+import time
+try:
+    import unittest.mock as mock
+except Exception:
+    import mock
+from fake_koji import FakeKojiSession
+from graffiti import cli
+from graffiti.asynckoji import AsyncKojiClient
+
+TAGS = {'zed-candidate': 1, 'zed-testing': 2}
+BUILDS = {'foo-1-1': 10, 'foo-2-1': 11, 'bar-1-1': 12}
+TAGGED = {'zed-candidate': ['foo-1-1', 'foo-2-1', 'bar-1-1'],
+          'zed-testing': ['foo-1-1']}
+
+
+class SlowSession(FakeKojiSession):
+    """Shares hub data and records concurrent requests
+    """
+    lock = threading.Lock()
+    running = 0
+    peak = 0
+
+    def _record(self, name, *args, **kwargs):
+        with self.lock:
+            SlowSession.running += 1
+            SlowSession.peak = max(SlowSession.peak, SlowSession.running)
+        time.sleep(0.01)
+        try:
+            return FakeKojiSession._record(self, name, *args, **kwargs)
+        finally:
+            with self.lock:
+                SlowSession.running -= 1
+
+
+def make_client(concurrency=2):
+    sessions = []
+
+    def new_session(url):
+        session = SlowSession(TAGS, BUILDS, TAGGED)
+        sessions.append(session)
+        return session
+
+    SlowSession.peak = 0
+    patcher = mock.patch('koji.ClientSession', new_session)
+    patcher.start()
+    return AsyncKojiClient('https://koji', concurrency), sessions, patcher
+
+
+def test_async_queries_are_concurrent_and_bounded():
+    client, sessions, patcher = make_client(concurrency=2)
+    try:
+        with client:
+            tags = client.run(client.retrieve_tags_builds(
+                ['zed-candidate', 'zed-testing'], ['foo', 'bar', 'baz']))
+    finally:
+        patcher.stop()
+    assert sorted(tags['zed-candidate']) == [10, 11, 12]
+    assert list(tags['zed-testing']) == [10]
+    assert SlowSession.peak == 2
+    # sessions are reused
+    assert len(sessions) == 2
+
+
+def test_async_builds_info_and_tag_ids():
+    client, _, patcher = make_client()
+    try:
+        with client:
+            info = client.run(client.retrieve_builds_info(
+                ['foo-1-1', 'missing-1-1']))
+            tag_ids = client.run(client._get_tag_ids(['zed-testing',
+                                                      'unknown']))
+            latest = client.run(client.retrieve_builds('zed-candidate'))
+    finally:
+        patcher.stop()
+    assert info['missing-1-1'] is None
+    assert sorted(info['foo-1-1']['tags']) == ['zed-candidate',
+                                               'zed-testing']
+    assert tag_ids == [2, None]
+    assert latest['foo']['id'] == 11
+
+
+def test_list_candidates_prefetches_with_async_client(capsys):
+    config = {'koji': {'url': 'https://koji', 'concurrency': 4},
+              'releases': {'zed': ['zed-candidate', 'zed-testing']},
+              'releases_info': {'zed': {'name': 'zed'}}}
+    args = mock.Mock(releases=['zed'], old=False, format='json', jobs=1,
+                     packages=None, packages_file=None, hub_latest=False,
+                     watch=None, from_snapshot=None)
+    _, _, patcher = make_client()
+    try:
+        with mock.patch('graffiti.cli.configure_koji') as configure_koji:
+            cli.list_candidates_cmd(config, args)
+    finally:
+        patcher.stop()
+    assert not configure_koji.called
+    assert '"foo-2-1"' in capsys.readouterr().out
+
+
+def test_hub_latest_is_not_prefetched():
+    config = {'koji': {'url': 'https://koji', 'concurrency': 4}}
+    args = mock.Mock(releases=['zed'], format='json', jobs=1,
+                     hub_latest=True, from_snapshot=None)
+    with mock.patch('graffiti.cli.prefetch_tags') as prefetch_tags, \
+            mock.patch('graffiti.cli.configure_koji'):
+        cli.output_releases(config, args,
+                            lambda koji, release: ('a', 'b', {}),
+                            lambda release: ['a', 'b'])
+    assert not prefetch_tags.called
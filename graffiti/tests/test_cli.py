@@ -0,0 +1,257 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+try:
+    import unittest.mock as mock
+except Exception:
+    import mock
+from fake_koji import FakeKojiSession
+from graffiti import cli
+from graffiti.kojiclient import KojiClient
+
+
+def test_run_releases_parallel_keeps_order():
+    sessions = []
+
+    def configure_koji(config):
+        session = object()
+        sessions.append(session)
+        return session
+
+    def func(koji, release):
+        return (release, threading.current_thread().name, koji)
+
+    releases = ['zed', 'antelope', 'bobcat', 'caracal', 'dalmatian']
+    with mock.patch('graffiti.cli.configure_koji', configure_koji):
+        results = cli.run_releases({}, releases, func, jobs=3)
+    assert [r[0] for r in results] == releases
+    # one session per worker thread
+    per_thread = dict((r[1], r[2]) for r in results)
+    assert len(set(per_thread.values())) == len(per_thread)
+    assert len(sessions) <= 3
+
+
+class FakeKoji(object):
+    def __init__(self, tags):
+        self.tags = tags
+        self.fetched = []
+
+    def retrieve_builds(self, tag, packages=None, latest=False):
+        self.fetched.append(tag)
+        latest = {}
+        for b in self.tags[tag]:
+            if packages is not None and b['name'] not in packages:
+                continue
+            if b['name'] not in latest or latest[b['name']]['id'] < b['id']:
+                latest[b['name']] = b
+        return latest
+
+    def retrieve_all_builds(self, tag, packages=None):
+        self.fetched.append(tag)
+        return dict((b['id'], b) for b in self.tags[tag]
+                    if packages is None or b['name'] in packages)
+
+    def retrieve_tags_builds(self, tags, packages=None):
+        return dict((tag, self.retrieve_all_builds(tag, packages))
+                    for tag in set(tags))
+
+
+CONFIG = {'releases': {'zed': ['zed-candidate', 'zed-testing',
+                               'zed-release']},
+          'releases_info': {'zed': {'name': 'zed'}}}
+
+TAGS = {'zed-candidate': [{'name': 'foo', 'id': 1, 'nvr': 'foo-1-1'},
+                          {'name': 'foo', 'id': 3, 'nvr': 'foo-2-1'},
+                          {'name': 'bar', 'id': 2, 'nvr': 'bar-1-1'}],
+        'zed-testing': [{'name': 'bar', 'id': 2, 'nvr': 'bar-1-1'}],
+        'zed-release': []}
+
+
+def test_list_candidates_jsonl(capsys):
+    args = mock.Mock(releases=['zed'], old=False, format='jsonl', jobs=1,
+                     packages=None, packages_file=None, hub_latest=False,
+                     watch=None, from_snapshot=None)
+    with mock.patch('graffiti.cli.configure_koji',
+                    return_value=FakeKoji(TAGS)):
+        cli.list_candidates_cmd(CONFIG, args)
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line) for line in lines] == \
+        [{'release': 'zed', 'tag_from': 'zed-candidate',
+          'tag_to': 'zed-testing', 'name': 'foo', 'id': 3,
+          'nvr': 'foo-2-1'}]
+
+
+def test_promotion_report_fetches_each_tag_once():
+    koji = FakeKoji(TAGS)
+    report = cli.compute_promotion_report(koji, CONFIG, 'zed')
+    assert sorted(koji.fetched) == sorted(TAGS)
+    assert report == [
+        {'report': 'candidates', 'tag_from': 'zed-candidate',
+         'tag_to': 'zed-testing',
+         'builds': {'foo': {'name': 'foo', 'id': 3, 'nvr': 'foo-2-1'}}},
+        {'report': 'old-candidates', 'tag_from': 'zed-candidate',
+         'tag_to': 'zed-testing', 'builds': {}},
+        {'report': 'testing', 'tag_from': 'zed-testing',
+         'tag_to': 'zed-release',
+         'builds': {'bar': {'name': 'bar', 'id': 2, 'nvr': 'bar-1-1'}}}]
+
+
+# graffiti CLI must be importable in less than STARTUP_TARGET seconds
+STARTUP_TARGET = 0.1
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+import graffiti.cli
+elapsed = time.time() - start
+heavy = [m for m in ('koji', 'yaml', 'distroinfo') if m in sys.modules]
+print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))
+"""
+
+
+def test_cli_startup():
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(cli.__file__))))
+    env = dict(os.environ, PYTHONPATH=root)
+    runs = [json.loads(subprocess.check_output(
+        [sys.executable, '-c', 'import json\n' + STARTUP_SCRIPT], env=env))
+        for _ in range(3)]
+    assert runs[0]['heavy'] == []
+    assert min(run['elapsed'] for run in runs) < STARTUP_TARGET
+
+
+def test_version_does_not_parse_config(capsys):
+    with mock.patch('sys.argv', ['graffiti', 'version']), \
+            mock.patch('graffiti.cli.config_module') as config_module:
+        try:
+            cli.main()
+        except SystemExit:
+            pass
+    assert not config_module.called
+    assert 'graffiti version' in capsys.readouterr().out
+
+
+def test_profile_flag_keeps_subcommand(capsys):
+    argv = ['graffiti', '--profile', 'list-candidates', 'zed']
+    with mock.patch('sys.argv', argv), \
+            mock.patch('graffiti.cli.config_module') as config_module, \
+            mock.patch('graffiti.cli.list_candidates_cmd') as command:
+        config_module.return_value.parse_config_file.return_value = CONFIG
+        try:
+            cli.main()
+        except SystemExit:
+            pass
+    args = command.call_args[0][1]
+    assert args.releases == ['zed'] and args.profile
+    assert 'koji RPC profile for list-candidates' in capsys.readouterr().err
+
+
+def test_selected_packages(tmpdir):
+    packages_file = tmpdir.join('packages')
+    packages_file.write('foo\n# comment\nbaz  # trailing\n\n')
+    args = mock.Mock(packages=['bar', 'foo'], packages_file=None)
+    assert cli.selected_packages(args) == ['bar', 'foo']
+    args = mock.Mock(packages=['bar', 'foo'], packages_file=str(packages_file))
+    assert cli.selected_packages(args) == ['bar', 'foo', 'baz']
+    args = mock.Mock(packages=None, packages_file=None)
+    assert cli.selected_packages(args) is None
+
+
+def test_iter_candidates_hub_latest_checks_changed_packages():
+    session = FakeKojiSession(
+        tags={'zed-candidate': 1, 'zed-testing': 2},
+        builds={'foo-0.9-1': 9, 'foo-1.0-1': 10, 'foo-1.1-1': 12,
+                'bar-1.0-1': 11},
+        # foo-1.0-1 was tagged again in candidate after foo-1.1-1
+        tagged={'zed-candidate': ['foo-1.1-1', 'bar-1.0-1', 'foo-1.0-1'],
+                'zed-testing': ['foo-0.9-1', 'bar-1.0-1']})
+    with mock.patch('koji.ClientSession', return_value=session):
+        koji = KojiClient('https://koji')
+    missing = dict(cli.iter_candidates(koji, 'zed-candidate', 'zed-testing',
+                                       hub_latest=True))
+    assert missing == {'foo': {'name': 'foo', 'id': 12, 'nvr': 'foo-1.1-1'}}
+
+
+def test_watch_releases_reports_changes_only():
+    session = FakeKojiSession(
+        tags={'zed-candidate': 1, 'zed-testing': 2, 'other': 3},
+        builds={'foo-1-1': 10, 'foo-2-1': 11, 'bar-1-1': 12},
+        tagged={'zed-candidate': ['foo-1-1', 'foo-2-1', 'bar-1-1'],
+                'zed-testing': ['foo-1-1', 'bar-1-1']})
+    with mock.patch('koji.ClientSession', return_value=session):
+        koji = KojiClient('https://koji')
+    actions = [lambda: session._tagBuild('other', 'foo-2-1'),
+               lambda: None,
+               lambda: session._tagBuild('zed-testing', 'foo-2-1'),
+               lambda: None]
+
+    def candidates(koji, release):
+        return ('zed-candidate', 'zed-testing',
+                cli.iter_candidates(koji, 'zed-candidate', 'zed-testing'))
+
+    changes = cli.watch_releases(koji, CONFIG, ['zed'], candidates, 1,
+                                 sleep=lambda interval: actions.pop(0)())
+    foo2 = {'name': 'foo', 'id': 11, 'nvr': 'foo-2-1'}
+    assert next(changes) == ('zed', 'zed-candidate', 'zed-testing',
+                             {'foo': foo2}, {})
+    # change in an unwatched tag is ignored, foo promotion is reported
+    assert next(changes) == ('zed', 'zed-candidate', 'zed-testing',
+                             {}, {'foo': foo2})
+    assert session.calls.count('listTagged') == 4
+    # history of both tags is not checked when koji event did not move
+    assert session.multicalled.count('queryHistory') == 4
+
+
+def test_dists_cmd_fetches_tags_once(capsys):
+    config = {'dists': {'el9s': CONFIG['releases'],
+                        'el10s': {'zed': ['zed10-candidate', 'zed-testing',
+                                          'zed-release']}},
+              'releases_info': CONFIG['releases_info']}
+    tags = dict(TAGS, **{'zed10-candidate': TAGS['zed-candidate'][2:]})
+    koji = FakeKoji(tags)
+    args = mock.Mock(cmd='list-candidates', centos_release=['9s', '10s'],
+                     releases=['zed'], old=False, format='json',
+                     packages=None, packages_file=None, hub_latest=False,
+                     from_snapshot=None)
+    with mock.patch('graffiti.cli.configure_koji', return_value=koji):
+        cli.dists_cmd(config, args)
+    assert json.loads(capsys.readouterr().out) == {
+        'el9s': {'foo': {'name': 'foo', 'id': 3, 'nvr': 'foo-2-1'}},
+        'el10s': {}}
+    assert sorted(koji.fetched) == ['zed-candidate', 'zed-testing',
+                                    'zed10-candidate']
+
+
+def test_list_candidates_from_snapshot(tmpdir, capsys):
+    path = str(tmpdir.join('zed.snapshot'))
+    koji = FakeKoji(TAGS)
+    koji.last_event = lambda: 42
+    with mock.patch('graffiti.cli.configure_koji', return_value=koji):
+        cli.snapshot_cmd(CONFIG, mock.Mock(releases=[], output=path))
+    assert 'at koji event 42' in capsys.readouterr().out
+    args = mock.Mock(releases=['zed'], old=False, format='json', jobs=1,
+                     packages=None, packages_file=None, hub_latest=False,
+                     watch=None, from_snapshot=path)
+    with mock.patch('graffiti.cli.configure_koji') as configure_koji:
+        cli.list_candidates_cmd(CONFIG, args)
+    assert not configure_koji.called
+    assert json.loads(capsys.readouterr().out) == {
+        'foo': {'name': 'foo', 'id': 3, 'nvr': 'foo-2-1'}}
+
+
+def test_register_pairs_shared_tags():
+    config = {'releases': {'zed': ['zed-candidate', 'common'],
+                           'antelope': ['antelope-candidate', 'common']}}
+    added, removed = cli.register_pairs(
+        config, {'zed': {'add': ['foo']}, 'antelope': {'add': ['foo']}})
+    assert sorted(added) == [('antelope-candidate', 'foo'),
+                             ('common', 'foo'), ('zed-candidate', 'foo')]
+    assert removed == []
+    try:
+        cli.register_pairs(config, {'zed': {'add': ['foo']},
+                                    'antelope': {'remove': ['foo']}})
+        assert False
+    except Exception as exc:
+        assert 'common foo' in str(exc)
@@ -5,7 +5,10 @@ try:
     import unittest.mock as mock
 except Exception:
     import mock
-from graffiti.config import parse_config_file
+import yaml
+from graffiti.config import merge_register_commands, merge_tag_commands
+from graffiti.config import parse_command_files
+from graffiti.config import parse_config, parse_config_file
 
 
 SAMPLE_CONFIG = """releases:
@@ -30,6 +33,15 @@ tags_maps:
     release: [2, 3]
 """
 
+RDOINFO_EL9 = """releases:
+- name: zed
+  repos:
+  - name: el9s
+    buildsys-tags: [zed9-candidate]
+  - name: el10s
+    buildsys-tags: [zed10-candidate]
+"""
+
 
 def test_parse_config_file():
     m = mock.mock_open(read_data=SAMPLE_CONFIG)
@@ -85,3 +97,63 @@ def test_parse_config_file():
                                      'candidate': [1],
                                      'testing': [2],
                                      'release': [2, 3]}}
+
+
+def test_parse_config_cache(tmpdir):
+    rdoinfo = tmpdir.mkdir('rdoinfo')
+    rdoinfo.join('rdo.yml').write('releases: []')
+    data = yaml.safe_load(SAMPLE_CONFIG)
+    data['cache'] = {'location': str(tmpdir.join('cache'))}
+    rdoinfo_mock = mock.Mock(side_effect=FakeRdoinfo)
+    with mock.patch('distroinfo.info.DistroInfo', rdoinfo_mock):
+        info = parse_config(data, str(rdoinfo))
+        assert rdoinfo_mock.call_count == 1
+        assert parse_config(data, str(rdoinfo)) == info
+        assert rdoinfo_mock.call_count == 1
+        # rdoinfo changes invalidate cache
+        rdoinfo.join('rdo.yml').write('releases: [] ')
+        parse_config(data, str(rdoinfo))
+        assert rdoinfo_mock.call_count == 2
+        parse_config(data, str(rdoinfo), refresh_cache=True)
+        assert rdoinfo_mock.call_count == 3
+
+
+def test_parse_config_several_dists(tmpdir):
+    data = yaml.safe_load(SAMPLE_CONFIG)
+    rdoinfo = yaml.safe_load(RDOINFO_EL9)
+    with mock.patch('distroinfo.info.DistroInfo') as distroinfo:
+        distroinfo.return_value.get_info.return_value = rdoinfo
+        info = parse_config(data, str(tmpdir), ['9s', '10s'])
+    assert distroinfo.call_count == 1
+    assert info['dists'] == {'el9s': {'zed': ['zed9-candidate']},
+                             'el10s': {'zed': ['zed10-candidate']}}
+    assert info['releases'] == info['dists']['el9s']
+
+
+def test_merge_command_files(tmpdir):
+    tmpdir.join('1-zed.yaml').write(
+        'zed:\n  testing: [foo-1-1, bar-1-1]\n  release: [foo-1-1]\n')
+    tmpdir.join('2-zed.yml').write('zed:\n  testing: [bar-1-1, baz-1-1]\n')
+    tmpdir.join('README').write('not a command file')
+    extra = tmpdir.join('extra.yaml')
+    extra.write('antelope:\n  candidate: [foo-1-1]\n')
+    parsed = parse_command_files([str(tmpdir), str(extra)])
+    # extra.yaml is both in the directory and given alone
+    assert [os.path.basename(f) for f, _ in parsed] == \
+        ['1-zed.yaml', '2-zed.yml', 'extra.yaml']
+    cmds, conflicts = merge_tag_commands(parsed)
+    # duplicates are dropped, last target wins
+    assert cmds == {'zed': {'release': ['foo-1-1'],
+                            'testing': ['bar-1-1', 'baz-1-1']},
+                    'antelope': {'candidate': ['foo-1-1']}}
+    assert [(r, b, [a for a, _ in actions])
+            for r, b, actions in conflicts] == \
+        [('zed', 'foo-1-1', ['testing', 'release'])]
+
+
+def test_merge_register_commands():
+    parsed = [('a.yaml', {'zed': {'add': ['foo', 'bar'], 'remove': ['foo']}}),
+              ('b.yaml', {'zed': {'add': ['bar', 'foo']}})]
+    cmds, conflicts = merge_register_commands(parsed)
+    assert cmds == {'zed': {'add': ['foo', 'bar']}}
+    assert [name for _, name, _ in conflicts] == ['foo']
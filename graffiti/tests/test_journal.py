@@ -0,0 +1,73 @@
+from fake_koji import FakeKojiSession
+from test_kojiclient import make_client
+from graffiti.journal import Journal, journal_path
+from graffiti.kojiclient import Operation
+from graffiti.multicall import MulticallError
+
+TAGS = {'zed-candidate': 1, 'zed-testing': 2}
+BUILDS = {'foo-1-1': 10, 'bar-1-1': 11}
+
+
+def test_journal_path():
+    assert journal_path(['cmds/tag.yaml', 'other.yaml']) == \
+        'cmds/tag.yaml.journal'
+    assert journal_path(['cmds/']) == 'cmds.journal'
+
+
+def test_resume_interrupted_plan(tmpdir):
+    session = FakeKojiSession(TAGS, BUILDS, {'zed-candidate': ['foo-1-1']})
+    client = make_client(session, multicall_batch=1)
+    journal = Journal(str(tmpdir.join('tag.yaml.journal')))
+    plan = [Operation('tag', 'zed-testing', 'foo-1-1'),
+            Operation('tag', 'zed-testing', 'baz-1-1'),
+            Operation('untag', 'zed-candidate', 'foo-1-1')]
+    journal.start(plan)
+    try:
+        client.apply_plan(plan, journal)
+        assert False
+    except MulticallError:
+        pass
+    assert journal.remaining() == [tuple(op) for op in plan[1:]]
+    # the missing build is now known
+    session.builds['baz-1-1'] = 12
+    remaining = [Operation(*op) for op in journal.remaining()]
+    client.apply_plan(remaining, journal)
+    assert journal.remaining() == []
+    assert session.tagged['zed-candidate'] == []
+    assert set(session.tagged['zed-testing']) == set(['foo-1-1', 'baz-1-1'])
+    # completed operations are not sent again
+    assert session.multicalled.count('tagBuild') == 3
+    assert session.multicalled.count('untagBuild') == 1
+
+
+def test_journal_ignores_truncated_line(tmpdir):
+    journal = Journal(str(tmpdir.join('journal')))
+    assert journal.remaining() is None
+    journal.start([('add', 'zed-candidate', 'foo')])
+    with open(journal.path, 'a') as journal_file:
+        journal_file.write('{"done": [["add", "zed-')
+    assert journal.remaining() == [('add', 'zed-candidate', 'foo')]
+
+
+def test_resume_requires_same_commands(tmpdir):
+    journal = Journal(str(tmpdir.join('journal')))
+    journal.start([('add', 'zed-candidate', 'foo')], 'digest')
+    assert journal.remaining('digest') == [('add', 'zed-candidate', 'foo')]
+    try:
+        journal.remaining('other')
+        assert False
+    except Exception as exc:
+        assert 'changed' in str(exc)
+
+
+def test_forced_untags_are_journaled(tmpdir):
+    session = FakeKojiSession(TAGS, BUILDS, {'zed-candidate': ['foo-1-1']})
+    session.packages = {'zed-candidate': set(['foo'])}
+    client = make_client(session)
+    journal = Journal(str(tmpdir.join('register.yaml.journal')))
+    journal.start([('remove', 'zed-candidate', 'foo')])
+    client.update_package_lists([], [('zed-candidate', 'foo')], 'owner',
+                                True, journal)
+    _, done = journal.load()
+    assert done == set([('untag', 'zed-candidate', 'foo-1-1'),
+                        ('remove', 'zed-candidate', 'foo')])
@@ -0,0 +1,288 @@
+from fake_koji import FakeKojiSession
+try:
+    import unittest.mock as mock
+except Exception:
+    import mock
+from graffiti.cache import TagCache
+from graffiti.kojiclient import KojiClient, Operation, split_plan
+from graffiti.mirror import TagMirror
+from graffiti.multicall import MulticallError
+
+
+TAGS = {'cloud9s-openstack-zed-candidate': 1,
+        'cloud9s-openstack-zed-testing': 2,
+        'cloud9s-openstack-zed-release': 3}
+
+
+def make_client(session, **kwargs):
+    with mock.patch('koji.ClientSession', return_value=session):
+        return KojiClient('https://koji', 'cert', 'ca', 'serverca', **kwargs)
+
+
+def test_tag_ids_resolved_once():
+    session = FakeKojiSession(tags=TAGS)
+    client = make_client(session)
+    tags = sorted(TAGS)
+    assert client._get_tag_ids(tags) == [TAGS[t] for t in tags]
+    assert client._get_tag_ids(tags) == [TAGS[t] for t in tags]
+    assert client._get_tag_id('unknown-tag') is None
+    assert session.calls.count('multiCall') == 2
+    assert 'listTags' not in session.calls
+
+
+def test_tag_cache(tmpdir):
+    session = FakeKojiSession(tags=TAGS)
+    cache = TagCache(str(tmpdir), 'https://koji')
+    make_client(session, tag_cache=cache)._get_tag_ids(sorted(TAGS))
+
+    session = FakeKojiSession(tags=TAGS)
+    client = make_client(session, tag_cache=cache)
+    assert client._get_tag_id('cloud9s-openstack-zed-testing') == 2
+    assert session.calls == []
+
+    client.invalidate_tag_index()
+    assert TagCache(str(tmpdir), 'https://koji').load() == {}
+    assert client._get_tag_id('cloud9s-openstack-zed-testing') == 2
+    assert 'multiCall' in session.calls
+
+
+def test_tag_cache_expires_each_tag(tmpdir):
+    cache = TagCache(str(tmpdir), 'https://koji', ttl=10)
+    with mock.patch('time.time', return_value=100):
+        cache.store({'old': 1})
+    with mock.patch('time.time', return_value=105):
+        cache.store(dict(cache.load(), new=2))
+    # resolving a new tag does not renew cached ones
+    with mock.patch('time.time', return_value=112):
+        assert cache.load() == {'new': 2}
+
+
+def test_tag_builds_fetches_build_info_once():
+    session = FakeKojiSession(
+        tags=TAGS,
+        builds={'foo-1.0-1.el9s': 10, 'bar-2.0-1.el9s': 11},
+        tagged={'cloud9s-openstack-zed-candidate': ['foo-1.0-1.el9s',
+                                                    'bar-2.0-1.el9s']})
+    client = make_client(session)
+    client.tag_builds('testing', sorted(TAGS, key=TAGS.get),
+                      ['foo-1.0-1.el9s', 'bar-2.0-1.el9s'],
+                      {'testing': [0, 1]})
+    assert session.multicalled.count('getBuild') == 2
+    assert session.calls.count('ssl_login') == 1
+    assert sorted(session.tagged['cloud9s-openstack-zed-testing']) == \
+        ['bar-2.0-1.el9s', 'foo-1.0-1.el9s']
+
+
+def test_tag_builds_reports_all_missing_builds():
+    session = FakeKojiSession(tags=TAGS, builds={'foo-1.0-1.el9s': 10})
+    client = make_client(session)
+    try:
+        client.tag_builds('candidate', sorted(TAGS, key=TAGS.get),
+                          ['foo-1.0-1.el9s', 'bar-2.0-1.el9s',
+                           'baz-1.0-1.el9s'],
+                          {'candidate': [0]})
+    except Exception as exc:
+        assert 'bar-2.0-1.el9s, baz-1.0-1.el9s' in str(exc)
+    else:
+        assert False, 'missing builds not reported'
+    assert 'tagBuild' not in session.multicalled
+
+
+def test_mirror_applies_tagging_history(tmpdir):
+    builds = {'foo-1.0-1.el9s': 10, 'foo-1.1-1.el9s': 12,
+              'bar-2.0-1.el9s': 11}
+    session = FakeKojiSession(
+        tags=TAGS, builds=builds,
+        tagged={'cloud9s-openstack-zed-testing': ['foo-1.0-1.el9s',
+                                                  'bar-2.0-1.el9s']})
+    path = str(tmpdir.join('mirror.sqlite'))
+    client = make_client(session, mirror=TagMirror(path))
+    assert sorted(client.retrieve_all_builds(
+        'cloud9s-openstack-zed-testing')) == [10, 11]
+    assert session.multicalled.count('listTagged') == 1
+
+    session.tagBuild(2, 'foo-1.1-1.el9s')
+    session.untagBuild(2, 'bar-2.0-1.el9s')
+    client = make_client(session, mirror=TagMirror(path))
+    latest = client.retrieve_builds('cloud9s-openstack-zed-testing')
+    assert latest == {'foo': {'name': 'foo', 'id': 12,
+                              'nvr': 'foo-1.1-1.el9s'}}
+    assert session.multicalled.count('listTagged') == 1
+    assert session.multicalled.count('queryHistory') == 1
+    # tag already synchronized in this session
+    client.retrieve_all_builds('cloud9s-openstack-zed-testing')
+    assert session.multicalled.count('queryHistory') == 1
+
+
+def test_plan_tag_builds_is_minimal_and_idempotent():
+    tags = sorted(TAGS, key=TAGS.get)
+    session = FakeKojiSession(
+        tags=TAGS, builds={'foo-1.0-1.el9s': 10, 'bar-2.0-1.el9s': 11},
+        tagged={'cloud9s-openstack-zed-candidate': ['foo-1.0-1.el9s',
+                                                    'bar-2.0-1.el9s'],
+                'cloud9s-openstack-zed-release': ['bar-2.0-1.el9s']})
+    client = make_client(session)
+    tags_map = {'testing': [0, 1]}
+    plan = client.plan_tag_builds('testing', tags,
+                                  ['foo-1.0-1.el9s', 'bar-2.0-1.el9s'],
+                                  tags_map)
+    assert plan == [
+        Operation('tag', 'cloud9s-openstack-zed-testing', 'foo-1.0-1.el9s'),
+        Operation('tag', 'cloud9s-openstack-zed-testing', 'bar-2.0-1.el9s'),
+        Operation('untag', 'cloud9s-openstack-zed-release',
+                  'bar-2.0-1.el9s')]
+    client.apply_plan(plan)
+    assert client.plan_tag_builds('testing', tags,
+                                  ['foo-1.0-1.el9s', 'bar-2.0-1.el9s'],
+                                  tags_map) == []
+    assert client.plan_tag_builds('none', tags, ['foo-1.0-1.el9s'],
+                                  tags_map) == [
+        Operation('untag', 'cloud9s-openstack-zed-candidate',
+                  'foo-1.0-1.el9s'),
+        Operation('untag', 'cloud9s-openstack-zed-testing',
+                  'foo-1.0-1.el9s')]
+
+
+def test_read_operations_are_anonymous():
+    session = FakeKojiSession(tags=TAGS)
+    with mock.patch('koji.ClientSession', return_value=session):
+        client = KojiClient('https://koji')
+    client.retrieve_builds('cloud9s-openstack-zed-candidate')
+    assert 'ssl_login' not in session.calls
+    try:
+        client.register_packages('cloud9s-openstack-zed-candidate', ['foo'],
+                                 'owner')
+    except Exception as exc:
+        assert 'certificate' in str(exc)
+    else:
+        assert False, 'write allowed without certificates'
+
+
+def test_retrieve_builds_for_packages():
+    session = FakeKojiSession(
+        tags=TAGS, builds={'foo-1.0-1.el9s': 10, 'foo-1.1-1.el9s': 12,
+                           'bar-2.0-1.el9s': 11},
+        tagged={'cloud9s-openstack-zed-candidate': ['foo-1.1-1.el9s',
+                                                    'foo-1.0-1.el9s',
+                                                    'bar-2.0-1.el9s']})
+    client = make_client(session)
+    assert client.retrieve_builds('cloud9s-openstack-zed-candidate',
+                                  ['foo']) == \
+        {'foo': {'name': 'foo', 'id': 12, 'nvr': 'foo-1.1-1.el9s'}}
+    assert session.multicalled.count('listTagged') == 1
+
+
+def test_update_package_lists_batches_all_tags():
+    session = FakeKojiSession(tags=TAGS)
+    client = make_client(session)
+    tags = sorted(TAGS)
+    report = client.update_package_lists(
+        [(tag, pkg) for tag in tags for pkg in ('foo', 'bar')],
+        [(tags[0], 'baz')], 'owner')
+    assert len(report.succeeded) == 7
+    assert session.multicalled.count('packageListAdd') == 6
+    assert session.multicalled.count('packageListRemove') == 1
+    # one getTag multicall, one for additions, one for removals
+    assert session.calls.count('multiCall') == 3
+
+
+def test_register_only_sends_needed_changes():
+    tags = sorted(TAGS)
+    session = FakeKojiSession(
+        TAGS, {'foo-1-1': 10, 'bar-1-1': 11},
+        {tags[0]: ['foo-1-1', 'bar-1-1'], tags[1]: ['foo-1-1']})
+    session.packages = {tags[0]: set(['foo', 'bar']), tags[1]: set(['foo'])}
+    client = make_client(session)
+    client.register_packages(tags, ['foo', 'bar'], 'owner')
+    assert session.multicalled.count('packageListAdd') == 3
+    client.register_packages(tags, ['foo', 'bar'], 'owner')
+    assert session.multicalled.count('packageListAdd') == 3
+    client.unregister_packages(tags, ['foo', 'baz'], force=True)
+    # foo builds are untagged in bulk before its removal
+    assert session.multicalled.count('packageListRemove') == 3
+    assert session.multicalled.count('untagBuild') == 2
+    assert session.tagged == {tags[0]: ['bar-1-1'], tags[1]: []}
+    assert session.packages == {tags[0]: set(['bar']), tags[1]: set(['bar']),
+                                tags[2]: set(['bar'])}
+
+
+def test_unchanged_register_is_anonymous():
+    tags = sorted(TAGS)
+    session = FakeKojiSession(TAGS)
+    session.packages = dict((tag, set(['foo'])) for tag in tags)
+    with mock.patch('koji.ClientSession', return_value=session):
+        client = KojiClient('https://koji')
+    added, removed = client.plan_package_lists(
+        [(tag, 'foo') for tag in tags], [(tags[0], 'bar')])
+    client.update_package_lists(added, removed, 'owner', True)
+    assert not client.authenticated
+    # one getTag multicall, one listPackages multicall
+    assert session.calls == ['multiCall', 'multiCall']
+
+
+def test_builds_info_from_tags_index():
+    tags = sorted(TAGS)
+    session = FakeKojiSession(
+        dict(TAGS, other=9), {'foo-1-1': 10, 'bar-1-1': 11, 'baz-1-1': 12},
+        {tags[0]: ['foo-1-1', 'bar-1-1'], tags[1]: ['foo-1-1'],
+         'other': ['baz-1-1']})
+    client = make_client(session)
+    info = client.retrieve_builds_info(['foo-1-1', 'baz-1-1', 'nope-1-1'],
+                                       tags)
+    assert sorted(info['foo-1-1']['tags']) == tags[:2]
+    assert info['baz-1-1']['tags'] == ['other']
+    assert info['nope-1-1'] is None
+    # only builds missing from the release tags are queried
+    assert session.multicalled.count('getBuild') == 2
+    assert session.multicalled.count('listTagged') == 3
+
+
+def test_builds_info_raises_transport_errors():
+    session = FakeKojiSession(TAGS, {'foo-1-1': 10})
+
+    def multiCall(strict=False, batch=None):
+        session._queue = []
+        raise IOError('Connection reset by peer')
+
+    session.multiCall = multiCall
+    client = make_client(session)
+    try:
+        client.retrieve_builds_info(['foo-1-1'])
+        assert False
+    except MulticallError as exc:
+        assert 'Connection reset by peer' in str(exc)
+
+
+def test_empty_plan_does_not_login():
+    session = FakeKojiSession(TAGS)
+    with mock.patch('koji.ClientSession', return_value=session):
+        client = KojiClient('https://koji')
+    client.apply_plan([])
+    assert not client.authenticated
+    assert session.calls == []
+
+
+def test_split_plan_keeps_builds_together():
+    plan = [Operation('tag', 'b', 'foo-1-1'), Operation('tag', 'b', 'bar-1-1'),
+            Operation('untag', 'a', 'foo-1-1'),
+            Operation('tag', 'c', 'baz-1-1')]
+    parts = split_plan(plan, 2)
+    assert parts == [[plan[0], plan[2]], [plan[1], plan[3]]]
+    assert split_plan(plan, 1) == [plan]
+    assert split_plan([], 4) == [[]]
+
+
+def test_apply_plan_concurrently():
+    tags = sorted(TAGS)
+    nvrs = ['pkg%d-1-1' % i for i in range(10)]
+    session = FakeKojiSession(TAGS, dict((nvr, i) for i, nvr in
+                                         enumerate(nvrs)), {tags[0]: nvrs})
+    client = make_client(session)
+    plan = [Operation(action, tag, nvr) for nvr in nvrs
+            for action, tag in (('tag', tags[1]), ('untag', tags[0]))]
+    report = client.apply_plan(plan, jobs=3)
+    assert len(report.succeeded) == 20
+    assert session.tagged[tags[0]] == []
+    assert sorted(session.tagged[tags[1]]) == sorted(nvrs)
+    # three sessions sent a tag then an untag multicall each
+    assert session.calls.count('multiCall') == 7
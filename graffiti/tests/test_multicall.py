@@ -0,0 +1,35 @@
+from fake_koji import FakeKojiSession
+from graffiti import multicall
+
+
+def test_execute_batches_and_reports_faults():
+    session = FakeKojiSession(tags={'tag-a': 1}, builds={'foo-1-1': 10})
+    calls = [multicall.call('getBuild', 'foo-1-1'),
+             multicall.call('listTags', 'missing-1-1'),
+             multicall.call('getTag', 'tag-a'),
+             multicall.call('getTag', 'tag-b'),
+             multicall.call('listTags', 'foo-1-1')]
+    report = multicall.execute(session, calls, batch_size=2)
+    assert session.calls.count('multiCall') == 3
+    assert len(report) == 5
+    assert report.results[0]['nvr'] == 'foo-1-1'
+    assert report.results[2] == {'name': 'tag-a', 'id': 1}
+    assert report.results[3] is None
+    assert [c for c, fault in report.failed] == [calls[1]]
+    assert len(report.succeeded) == 4
+    try:
+        report.check()
+    except multicall.MulticallError as exc:
+        assert exc.report is report
+        assert 'missing-1-1' in str(exc)
+    else:
+        assert False, 'failure not raised'
+
+
+def test_execute_concurrent_batches_keep_order():
+    tags = dict(('tag-%d' % i, i) for i in range(50))
+    session = FakeKojiSession(tags=tags)
+    calls = [multicall.call('getTag', 'tag-%d' % i) for i in range(50)]
+    report = multicall.execute(session, calls, batch_size=7, jobs=3)
+    assert [r['id'] for r in report.check().results] == list(range(50))
+    assert session.calls.count('multiCall') == 8
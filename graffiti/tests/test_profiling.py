@@ -0,0 +1,54 @@
+import json
+import koji
+try:
+    import unittest.mock as mock
+except Exception:
+    import mock
+from graffiti import cli
+from graffiti import profiling
+
+
+def fake_hub(handler, headers, request):
+    if b'multiCall' in request:
+        return [[{'id': 1}], [{'id': 2}]]
+    return {'id': 1}
+
+
+def test_instrument_records_calls_and_multicalls():
+    stats = profiling.RPCStats()
+    events = []
+    stats.add_hook(events.append)
+    session = koji.ClientSession('http://localhost/kojihub')
+    session._sendCall = fake_hub
+    profiling.instrument(session, stats)
+
+    assert session.getTag('tag-a') == {'id': 1}
+    session.multicall = True
+    session.getTag('tag-a')
+    session.getTag('tag-b')
+    assert len(session.multiCall()) == 2
+
+    summary = stats.summary()
+    assert summary['requests'] == 2
+    assert summary['methods']['getTag']['count'] == 1
+    assert summary['methods']['getTag']['bytes_out'] > 0
+    assert summary['multicalls'] == {'count': 1, 'calls': 2, 'max_size': 2}
+    assert [e['method'] for e in events] == ['getTag', 'multiCall']
+    assert events[1]['calls'] == ['getTag', 'getTag']
+
+
+def test_profile_and_profile_file(tmpdir, capsys):
+    stats_file = str(tmpdir.join('stats.json'))
+    argv = ['graffiti', '--profile', '--profile-file', stats_file,
+            'list-candidates', 'zed']
+    with mock.patch('sys.argv', argv), \
+            mock.patch('graffiti.cli.config_module') as config_module, \
+            mock.patch('graffiti.cli.list_candidates_cmd'):
+        config_module.return_value.parse_config_file.return_value = {}
+        try:
+            cli.main()
+        except SystemExit:
+            pass
+    assert 'koji RPC profile for list-candidates' in capsys.readouterr().err
+    with open(stats_file) as stats:
+        json.load(stats)
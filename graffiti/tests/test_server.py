@@ -0,0 +1,162 @@
+import json
+import threading
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+from fake_koji import FakeKojiSession
+from test_kojiclient import make_client
+from graffiti import server
+from graffiti.mirror import TagMirror
+
+TAGS = {'zed-candidate': 1, 'zed-testing': 2, 'zed-release': 3}
+BUILDS = {'foo-1-1': 10, 'foo-2-1': 11, 'bar-1-1': 12}
+TAGGED = {'zed-candidate': ['foo-1-1', 'foo-2-1', 'bar-1-1'],
+          'zed-testing': ['foo-1-1', 'bar-1-1'],
+          'zed-release': []}
+
+CONFIG = {'releases': {'zed': ['zed-candidate', 'zed-testing',
+                               'zed-release']},
+          'releases_info': {'zed': {'name': 'zed'}},
+          'tags_maps': {'unified_buildreqs': {'testing': [0, 1]}}}
+
+
+def make_service(allow_tag=False, config_key=None):
+    session = FakeKojiSession(TAGS, BUILDS, TAGGED)
+
+    def configure_koji(config):
+        client = make_client(session)
+        client.authenticated = True
+        return client
+
+    service = server.GraffitiService(lambda: CONFIG, configure_koji,
+                                     allow_tag=allow_tag,
+                                     config_key=config_key)
+    return service, session
+
+
+def test_service_answers_from_snapshot():
+    service, session = make_service()
+    assert service.refresh()
+    calls = len(session.calls)
+    result = service.list_candidates('zed')
+    assert result['builds'] == {
+        'foo': {'name': 'foo', 'id': 11, 'nvr': 'foo-2-1'}}
+    assert service.list_testing('zed')['builds'] == {
+        'foo': {'name': 'foo', 'id': 10, 'nvr': 'foo-1-1'},
+        'bar': {'name': 'bar', 'id': 12, 'nvr': 'bar-1-1'}}
+    assert service.list_candidates('zed', packages=['bar'])['builds'] == {}
+    # queries do not reach koji
+    assert len(session.calls) == calls
+    # nothing changed since last event
+    assert not service.refresh()
+
+
+def test_service_refreshes_after_tag_job():
+    service, session = make_service(allow_tag=True)
+    service.refresh()
+    job_id = service.submit_tag({'zed': {'testing': ['foo-2-1']}})
+    service.run_job(*service._job_queue.get())
+    assert service.job(job_id)['status'] == 'done'
+    assert service.job(job_id)['operations'] == ['tag zed-testing foo-2-1']
+    assert service.refresh()
+    assert service.list_candidates('zed')['builds'] == {}
+
+
+def test_service_refreshes_changed_tags_only():
+    service, session = make_service(allow_tag=True,
+                                    config_key=lambda config: 'key')
+    service.load_config = lambda: dict(CONFIG)
+    service.refresh()
+    loaded = service.config
+    service.submit_tag({'zed': {'testing': ['foo-2-1']}})
+    service.run_job(*service._job_queue.get())
+    calls = session.multicalled.count('listTagged')
+    assert service.refresh()
+    # only zed-testing was tagged into
+    assert session.multicalled.count('listTagged') == calls + 1
+    # configuration fingerprint did not change
+    assert service.config is loaded
+    assert service.list_candidates('zed')['builds'] == {}
+
+
+def test_service_refreshes_mirror_from_another_thread(tmpdir):
+    session = FakeKojiSession(TAGS, BUILDS, TAGGED)
+    mirror = TagMirror(str(tmpdir.join('mirror.db')))
+    service = server.GraffitiService(
+        lambda: CONFIG, lambda config: make_client(session, mirror=mirror))
+    service.refresh()
+    session._tagBuild('zed-testing', 'foo-2-1')
+    errors = []
+
+    def refresh():
+        try:
+            service.refresh()
+        except Exception as exc:
+            errors.append(exc)
+
+    thread = threading.Thread(target=refresh)
+    thread.start()
+    thread.join()
+    assert errors == []
+    assert service.list_candidates('zed')['builds'] == {}
+
+
+def test_service_rebuilds_client_on_koji_change():
+    service, session = make_service()
+    clients = []
+    configure_koji = service.configure_koji
+    service.configure_koji = lambda config: clients.append(config) or \
+        configure_koji(config)
+    service.refresh()
+    service.refresh()
+    assert len(clients) == 1
+    service.load_config = lambda: dict(CONFIG, koji={'url': 'https://other'})
+    assert service.refresh()
+    assert len(clients) == 2
+
+
+def test_service_errors():
+    service, _ = make_service()
+    try:
+        service.list_candidates('zed')
+        assert False
+    except server.ServiceError as exc:
+        assert exc.status == 503
+    service.refresh()
+    try:
+        service.submit_tag({})
+        assert False
+    except server.ServiceError as exc:
+        assert exc.status == 403
+
+
+def test_http_api():
+    service, _ = make_service()
+    service.refresh()
+    httpd = server.Server(('127.0.0.1', 0), service)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(httpd.server_address[1])
+    try:
+        result = json.loads(urlopen(url + '/list-candidates/zed?old=1')
+                            .read().decode('utf-8'))
+        assert result['release'] == 'zed'
+        assert result['builds'] == {}
+        assert json.loads(urlopen(url + '/releases').read()
+                          .decode('utf-8')) == ['zed']
+        try:
+            urlopen(Request(url + '/tag', data=b'{}'))
+            assert False
+        except HTTPError as exc:
+            assert exc.code == 403
+        try:
+            urlopen(url + '/list-candidates/unknown')
+            assert False
+        except HTTPError as exc:
+            assert exc.code == 404
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
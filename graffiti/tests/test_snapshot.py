@@ -0,0 +1,63 @@
+import gzip
+import json
+from graffiti.snapshot import TagBuilds, TagSnapshot, latest_from_all
+
+LISTING = [{'build_id': 3, 'package_name': 'foo', 'nvr': 'foo-2-1'},
+           {'build_id': 2, 'package_name': 'bar', 'nvr': 'bar-1-1'},
+           {'build_id': 1, 'package_name': 'foo', 'nvr': 'foo-1-1'}]
+
+
+def test_tag_builds_is_a_read_only_mapping():
+    builds = TagBuilds.from_listing(iter(LISTING))
+    expected = dict((b['build_id'], {'name': b['package_name'],
+                                     'id': b['build_id'], 'nvr': b['nvr']})
+                    for b in LISTING)
+    assert builds == expected
+    assert dict(builds) == expected
+    assert 2 in builds and 4 not in builds
+    assert json.loads(json.dumps(dict(builds))) == \
+        json.loads(json.dumps(expected))
+    assert latest_from_all(builds) == latest_from_all(expected)
+    assert builds.filter(['bar']) == {2: expected[2]}
+    # package names are shared between builds
+    assert builds._names[0] is builds._names[2]
+
+
+def test_older_than_latest():
+    candidates = TagBuilds([1, 2, 3, 4, 5], ['foo', 'foo', 'bar', 'foo',
+                                             'baz'],
+                           ['foo-1', 'foo-2', 'bar-1', 'foo-4', 'baz-1'])
+    testing = {4: {'name': 'foo', 'id': 4, 'nvr': 'foo-4'},
+               2: {'name': 'foo', 'id': 2, 'nvr': 'foo-2'}}
+    assert dict(candidates.older_than_latest(testing)) == {
+        1: {'name': 'foo', 'id': 1, 'nvr': 'foo-1'}}
+
+
+def test_snapshot_queries():
+    snapshot = TagSnapshot({'zed-candidate': TagBuilds.from_listing(LISTING)})
+    assert snapshot.retrieve_builds('zed-candidate')['foo']['nvr'] == \
+        'foo-2-1'
+    assert list(snapshot.retrieve_all_builds('zed-candidate', ['bar'])) == [2]
+
+
+def test_snapshot_dump_and_load(tmpdir):
+    path = str(tmpdir.join('snapshot'))
+    TagSnapshot({'zed-candidate': TagBuilds.from_listing(LISTING),
+                 'zed-testing': {}}, 42, 1.5).dump(path)
+    snapshot = TagSnapshot.load(path)
+    assert (snapshot.event, snapshot.timestamp) == (42, 1.5)
+    assert dict(snapshot.tags['zed-candidate']) == \
+        dict(TagBuilds.from_listing(LISTING))
+    assert len(snapshot.tags['zed-testing']) == 0
+    info = snapshot.retrieve_builds_info(['bar-1-1', 'baz-1-1'])
+    assert info['bar-1-1']['tags'] == ['zed-candidate']
+    assert info['baz-1-1'] is None
+    with gzip.open(path, 'rb') as stream:
+        data = stream.read()
+    with gzip.open(path, 'wb') as stream:
+        stream.write(data[:-4])
+    try:
+        TagSnapshot.load(path)
+        assert False
+    except Exception as e:
+        assert 'truncated' in str(e)